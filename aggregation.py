@@ -1,45 +1,171 @@
 from text_sim import TextSimilarity
 from llms import LLM
+import tracing
+from rouge import lcs_length, fmeasure
+import numpy as np
+import hashlib
+import json
+import re
 import pdb
 
 
+_ALNUM = re.compile('[a-z0-9]')
+_CONF_WORDS = {'low': 0.25, 'medium': 0.5, 'median': 0.5, 'high': 0.75}
+_CONF_WORD = re.compile(r'\b(low|medium|median|high)\b', re.IGNORECASE)
+# a number, optionally followed by % or /denominator
+_CONF_NUM = re.compile(r'(?<![\w.])(\d+(?:\.\d+)?|\.\d+)\s*(?:(%)|/\s*(\d+(?:\.\d+)?))?')
+
+
+def _merges(a: str, b: str) -> bool:
+    # whether the last word of `a` and the first word of `b` become one ROUGE token when concatenated
+    return bool(a) and bool(b) and bool(_ALNUM.match(a[-1].lower())) and bool(_ALNUM.match(b[0].lower()))
+
+
+class RunningConfidence:
+    """
+    the running weighted mean of the confidence, and its standard error,
+    updated as each output arrives
+    """
+
+    def __init__(self) -> None:
+        self.n = 0
+        self.sum_wt = 0.
+        self.sum_wt2 = 0.
+        self.sum_conf = 0.
+        self.sum_conf2 = 0.
+
+    def add(self, conf: float, wt: float):
+        self.n += 1
+        self.sum_wt += wt
+        self.sum_wt2 += wt * wt
+        self.sum_conf += conf * wt
+        self.sum_conf2 += conf * conf * wt
+
+    @property
+    def mean(self) -> float:
+        return self.sum_conf / self.sum_wt
+
+    @property
+    def var(self) -> float:
+        # weighted variance of the per-sample confidence
+        return max(self.sum_conf2 / self.sum_wt - self.mean ** 2, 0.)
+
+    @property
+    def stderr(self) -> float:
+        # standard error of the weighted mean, using the effective sample size
+        n_eff = self.sum_wt ** 2 / self.sum_wt2 if self.sum_wt2 > 0 else 0.
+        if n_eff <= 1:
+            return np.inf
+        return np.sqrt(self.var / (n_eff - 1))
+
+
 class Aggregation:
 
-    def __init__(self, weighted=True) -> None:
-        self.text_sim = TextSimilarity()
+    def __init__(self, weighted=True, text_sim: TextSimilarity = None) -> None:
+        self.text_sim = text_sim if text_sim is not None else TextSimilarity()
         self.weighted = weighted
     
 
-    def calc_wt(self, inp0_turns, inp_turns):
+    def calc_wt(self, inp0_turns, inp_turns, diff0=None, diff=None):
+        """
+        the rougeL similarity between the inputs.
+        given how each of them differs from the original messages (see `Perturbation.perturb_with_diff`),
+        only the perturbed parts are scored, instead of the whole conversation, for the same result
+        """
         if not self.weighted:
             return 1.
         
-        inp0 = '\n'.join([turn['content'] for turn in inp0_turns])
-        inp = '\n'.join([turn['content'] for turn in inp_turns])
-        return self.text_sim.score(inp0, inp, method='rougeL')
+        with tracing.span('aggregation.calc_wt'):
+            if diff0 is not None and diff is not None:
+                wt = self.diff_wt(inp0_turns, inp_turns, diff0, diff)
+                if wt is not None:
+                    return wt
+            inp0 = '\n'.join([turn['content'] for turn in inp0_turns])
+            inp = '\n'.join([turn['content'] for turn in inp_turns])
+            return self.text_sim.score(inp0, inp, method='rougeL')
+
+
+    def diff_wt(self, inp0_turns, inp_turns, diff0, diff):
+        """
+        the rougeL weight from the diff descriptors, or None if they are not enough to tell.
+        the turns are joined by '\\n', so the tokens of the joined text are the tokens of the turns concatenated,
+        and the LCS of two token sequences sharing a prefix (or suffix) is that prefix plus the LCS of the rest
+        """
+        if diff0['kind'] != diff['kind']:
+            return None
+        rouge = self.text_sim.rouge
+        n_tokens = lambda turns: sum(len(rouge.tokens(turn['content'])) for turn in turns)
+
+        if diff['kind'] == 'same':
+            lcs = n0 = n = n_tokens(inp_turns)
+
+        elif diff['kind'] in ['system', 'last']:
+            if diff['kind'] == 'last':
+                shared = n_tokens(inp_turns[:-1])
+            elif diff.get('tail', False) != diff0.get('tail', False):
+                return None
+            elif diff.get('tail', False):
+                # the system turn is the one before the last, between a shared prefix and a shared suffix
+                shared = n_tokens(inp_turns[:-2]) + n_tokens(inp_turns[-1:])
+            else:
+                shared = n_tokens(inp_turns[1:])
+            a, b = rouge.tokens(diff0['content']), rouge.tokens(diff['content'])
+            lcs = shared + lcs_length(a, b)
+            n0 = shared + len(a)
+            n = shared + len(b)
+
+        elif diff['kind'] == 'affix':
+            content = inp_turns[-1]['content']
+            orig = content[len(diff['prefix']): len(content) - len(diff['suffix'])]
+            for d in [diff0, diff]:
+                if _merges(d['prefix'], orig) or _merges(orig, d['suffix']):
+                    return None
+            shared = n_tokens(inp_turns[:-1])
+            mid = len(rouge.tokens(orig))
+            pre0, suf0 = rouge.tokens(diff0['prefix']), rouge.tokens(diff0['suffix'])
+            pre, suf = rouge.tokens(diff['prefix']), rouge.tokens(diff['suffix'])
+            if pre0.words == pre.words:
+                lcs_last = len(pre) + mid + lcs_length(suf0, suf)
+            elif suf0.words == suf.words:
+                lcs_last = lcs_length(pre0, pre) + mid + len(suf)
+            else:
+                lcs_last = lcs_length(rouge.tokens(inp0_turns[-1]['content']), rouge.tokens(content))
+            lcs = shared + lcs_last
+            n0 = shared + len(pre0) + mid + len(suf0)
+            n = shared + len(pre) + mid + len(suf)
+
+        else:
+            return None
+
+        if not n0 or not n:
+            return 0.
+        return fmeasure(lcs / n, lcs / n0)
     
 
 class IntraSampleAggregation(Aggregation):
     """
     let the LLM express (verbalize) its uncertainty
     see: https://arxiv.org/abs/2205.14334
+
+    in `aggregate`, the confidence questions of all the outputs are sent together (up to `max_workers` in flight),
+    and the identical ones only once
     """
 
-    def __init__(self, llm: LLM, kind: str, weighted=True) -> None:
-        super().__init__(weighted)
+    def __init__(self, llm: LLM, kind: str, weighted=True, text_sim: TextSimilarity = None, max_workers=1) -> None:
+        super().__init__(weighted, text_sim)
 
         self.llm = llm
         assert(kind in ['verbalized_word', 'verbalized_num'])
         self.kind = kind 
+        self.max_workers = max_workers
         if self.kind == 'verbalized_word':
             self.prompt = 'Your confidence is? (low, median, high)'
         else:
             self.prompt = 'Your confidence is? (a float score between 0.0 to 1.0)'
 
-        
-    def single_confidence(self, inp: list, out: str) -> float:
-        
-        turns = inp[:] + [
+
+    def followup(self, inp: list, out: str) -> list:
+        return list(inp) + [
             {
                 'role': 'assistant',
                 'content': out,
@@ -49,55 +175,204 @@ class IntraSampleAggregation(Aggregation):
                 'content': self.prompt
             }
         ]
-        verbalized = self.llm.generate(turns, temperature=0.)
 
-        if self.kind == 'word':
-            if 'low' in verbalized.lower():
-                return 0.25
-            elif 'high' in verbalized.lower():
-                return 0.75
+
+    def extract(self, verbalized: str) -> float:
+        """
+        the confidence expressed in `verbalized`, 0.5 if none is found.
+        words: the first of low / medium (or median) / high.
+        numbers: the first one in [0, 1], or a percentage (e.g. 85%), or a fraction (e.g. 8/10)
+        """
+        if not verbalized:
+            return 0.5
+        if self.kind == 'verbalized_word':
+            match = _CONF_WORD.search(verbalized)
+            if match:
+                return _CONF_WORDS[match.group(1).lower()]
         else:
-            for w in verbalized.split():
-                try:
-                    conf = float(w)
-                except:
-                    continue
-                if conf >= 0 and conf <= 1:
+            for match in _CONF_NUM.finditer(verbalized):
+                conf = float(match.group(1))
+                if match.group(2):
+                    conf /= 100
+                elif match.group(3):
+                    denominator = float(match.group(3))
+                    if denominator <= 0:
+                        continue
+                    conf /= denominator
+                if 0 <= conf <= 1:
                     return conf
         return 0.5
+
+        
+    def single_confidence(self, inp: list, out: str) -> float:
+        verbalized = self.llm.generate(self.followup(inp, out), temperature=0.)
+        return self.extract(verbalized)
+
+
+    def confidences(self, inp_out: list) -> list:
+        """
+        the confidence of each (input, output) pair, asked in one batch (see `LLM.generate_many`)
+        """
+        unique = {}
+        for inp, out in inp_out:
+            unique.setdefault((id(inp), out), (inp, out))
+        keys = list(unique)
+        verbalized = self.llm.generate_many([(self.followup(*unique[k]), 0.) for k in keys], max_workers=self.max_workers)
+        conf = {k: self.extract(v) for k, v in zip(keys, verbalized)}
+        return [conf[(id(inp), out)] for inp, out in inp_out]
     
 
-    def aggregate(self, inp_out: list) -> float:
+    def aggregate(self, inp_out: list, diffs: list = None) -> float:
         sum_conf = 0.
         sum_wt = 0.
         inp0, _ = inp_out[0]
-        for inp, out in inp_out:
-            conf = self.single_confidence(inp, out)
-            wt = self.calc_wt(inp0, inp)
+        diffs = diffs or [None] * len(inp_out)
+        confs = self.confidences(inp_out)
+        for (inp, out), diff, conf in zip(inp_out, diffs, confs):
+            wt = self.calc_wt(inp0, inp, diffs[0], diff)
             sum_conf += conf * wt
             sum_wt += wt
         return sum_conf / sum_wt
 
 
+    def update(self, estimate: RunningConfidence, inp_out: list, i: int, diffs: list = None):
+        """
+        fold the i-th (input, output) pair into the running estimate
+        """
+        inp0, _ = inp_out[0]
+        inp, out = inp_out[i]
+        diffs = diffs or [None] * len(inp_out)
+        estimate.add(self.single_confidence(inp, out), self.calc_wt(inp0, inp, diffs[0], diffs[i]))
+
+
 class InterSampleAggregation(Aggregation):
     """
     measuring the text similarity between the outputs as the confidence
+
+    `pairs` selects the outputs compared:
+    * `anchor`: the first output against each of the others
+    * `all`: all the pairs, from the N x N similarity matrix (see `TextSimilarity.similarity_matrix`),
+      so the confidence does not depend on which output comes first
+    * `sampled`: `n_pairs` random pairs (by default N), for the `mean` only. the pairs are drawn from a seed
+      derived from `seed` and the outputs, so the same outputs always get the same confidence
+
+    `consistency` selects how the all-pairs matrix becomes the confidence (see `consistency_scores`):
+    `mean`, `spectral` or `cluster`
     """
 
-    def __init__(self, metric: str, weighted=True) -> None:
-        super().__init__(weighted)
+    def __init__(self, metric: str, weighted=True, text_sim: TextSimilarity = None,
+                 pairs='anchor', consistency='mean', n_pairs=None, cluster_threshold=0.5, seed=0) -> None:
+        super().__init__(weighted, text_sim)
         self.metric = metric
+        assert(pairs in ['anchor', 'all', 'sampled'])
+        assert(consistency in ['mean', 'spectral', 'cluster'])
+        assert(pairs == 'all' or consistency == 'mean')
+        self.pairs = pairs
+        self.consistency = consistency
+        self.n_pairs = n_pairs
+        self.cluster_threshold = cluster_threshold
+        self.seed = seed
+
+
+    def weights(self, inp_out: list, diffs: list = None) -> np.ndarray:
+        inp0, _ = inp_out[0]
+        diffs = diffs or [None] * len(inp_out)
+        return np.array([self.calc_wt(inp0, inp, diffs[0], diff) for (inp, _), diff in zip(inp_out, diffs)])
+
+
+    def consistency_scores(self, sim: np.ndarray, wt: np.ndarray) -> dict:
+        """
+        from the N x N similarity matrix `sim` and the sample weights `wt`:
+        * `mean`: the weighted mean similarity over all the pairs
+        * `spectral`: the largest eigenvalue of the weighted similarity matrix, normalized so that
+          identical outputs score 1, and N unrelated outputs (of equal weight) score 1 / N
+        * `cluster`: the weighted fraction of the outputs in the largest cluster,
+          the clusters being connected by the pairs with a similarity of at least `cluster_threshold`
+        """
+        n = len(wt)
+        pair_wt = np.outer(wt, wt)
+        np.fill_diagonal(pair_wt, 0.)
+        mean = float((pair_wt * sim).sum() / pair_wt.sum()) if pair_wt.sum() > 0 else 0.
 
+        sqrt_wt = np.sqrt(wt)
+        spectral = float(np.linalg.eigvalsh(sqrt_wt[:, None] * sim * sqrt_wt[None, :])[-1] / wt.sum())
+
+        cluster = np.full(n, -1)
+        for i in range(n):
+            if cluster[i] >= 0:
+                continue
+            cluster[i] = i
+            stack = [i]
+            while stack:
+                j = stack.pop()
+                for k in np.nonzero((sim[j] >= self.cluster_threshold) & (cluster < 0))[0]:
+                    cluster[k] = i
+                    stack.append(k)
+        largest = max(wt[cluster == c].sum() for c in set(cluster))
+
+        return {'mean': mean, 'spectral': spectral, 'cluster': float(largest / wt.sum())}
+
+
+    def aggregate(self, inp_out: list, diffs: list = None) -> float:
+        if self.pairs == 'all':
+            sim = self.text_sim.similarity_matrix([out for _, out in inp_out], method=self.metric)
+            return self.consistency_scores(sim, self.weights(inp_out, diffs))[self.consistency]
+
+        if self.pairs == 'sampled':
+            return self.sampled_mean(inp_out, diffs)
 
-    def aggregate(self, inp_out: list) -> float:
         sum_conf = 0.
         sum_wt = 0.
         inp0, out0 = inp_out[0]
+        diffs = diffs or [None] * len(inp_out)
+        confs = self.text_sim.score_batch(out0, [out for _, out in inp_out[1:]], method=self.metric)
         for i in range(1, len(inp_out)):
-            inp, out = inp_out[i]
-            wt = self.calc_wt(inp0, inp)
-            conf = self.text_sim.score(out0, out, method=self.metric)
+            inp, _ = inp_out[i]
+            wt = self.calc_wt(inp0, inp, diffs[0], diffs[i])
+            conf = confs[i - 1]
             sum_conf += conf * wt
             sum_wt += wt
         return sum_conf / sum_wt
 
+
+    def sampled_mean(self, inp_out: list, diffs: list = None) -> float:
+        """
+        the weighted mean similarity over `n_pairs` random pairs, grouped by their first output to be batch-scored
+        """
+        n = len(inp_out)
+        all_pairs = [(i, j) for i in range(n) for j in range(i + 1, n)]
+        n_pairs = min(self.n_pairs or n, len(all_pairs))
+        # a generator per call, not shared between the threads
+        digest = hashlib.sha256(json.dumps([out for _, out in inp_out]).encode('utf-8')).digest()
+        rng = np.random.RandomState([self.seed, int.from_bytes(digest[:4], 'little')])
+        sampled = sorted(all_pairs[k] for k in rng.choice(len(all_pairs), n_pairs, replace=False))
+        wt = self.weights(inp_out, diffs)
+        sum_conf = 0.
+        sum_wt = 0.
+        for i in sorted(set(i for i, _ in sampled)):
+            jj = [j for _i, j in sampled if _i == i]
+            confs = self.text_sim.score_batch(inp_out[i][1], [inp_out[j][1] for j in jj], method=self.metric)
+            sum_conf += (wt[i] * wt[jj] * confs).sum()
+            sum_wt += (wt[i] * wt[jj]).sum()
+        return float(sum_conf / sum_wt)
+
+
+    def update(self, estimate: RunningConfidence, inp_out: list, i: int, diffs: list = None):
+        """
+        fold the i-th (input, output) pair into the running estimate.
+        the first output is the anchor the others are compared against, it adds no sample itself.
+        with `pairs` other than `anchor`, the i-th output is compared against all the previous ones,
+        i.e. the running estimate is the `mean` consistency, whatever `consistency` is.
+        """
+        if i == 0:
+            return
+        inp0, out0 = inp_out[0]
+        inp, out = inp_out[i]
+        diffs = diffs or [None] * len(inp_out)
+        if self.pairs == 'anchor':
+            conf = self.text_sim.score(out0, out, method=self.metric)
+        else:
+            wt = self.weights(inp_out[:i], diffs[:i])
+            confs = self.text_sim.score_batch(out, [_out for _, _out in inp_out[:i]], method=self.metric)
+            conf = (wt * confs).sum() / wt.sum() if wt.sum() > 0 else confs.mean()
+        estimate.add(conf, self.calc_wt(inp0, inp, diffs[0], diffs[i]))
@@ -0,0 +1,264 @@
+"""
+run SPUQ over a JSONL file of queries, and write the reports to a JSONL file, as they complete.
+
+each input line is {"id": ..., "messages": [...]} or {"id": ..., "prompt": "..."} (the id defaults to the line number).
+each output line is {"id": ..., "confidence": ..., "outputs": [...], "perturbed": [[messages, temperature], ...]}.
+the files are gzip-compressed if their name ends with .gz.
+
+the input is streamed, and the reports are written (and dropped) in chunks, so the memory use does not grow
+with the size of the input. after each chunk, the line numbers of the completed queries (as ranges) and the size
+of the output file are appended to the checkpoint file, so that `--resume` skips the completed queries
+(the input may only be appended to in between), and cuts off whatever was written after the last checkpoint. the failed queries (e.g. rate limited beyond the retries) are reported on stderr,
+and not checkpointed, so they are run again on resume.
+
+python batch.py queries.jsonl --out reports.jsonl.gz --perturbation paraphrasing --aggregation rougeL \\
+    --n-perturb 5 --max-queries 16 --max-concurrency 32 --cache spuq_cache.sqlite
+python batch.py queries.jsonl --out reports.jsonl.gz ... --resume
+"""
+
+import argparse
+import bisect
+import gzip
+import json
+import os
+import sys
+from llms import LLM, OpenAIBackend, LocalBackend, FakeBackend
+from cache import SQLiteResponseCache
+from spuq import SPUQ, PERTURBATIONS, AGGREGATIONS
+
+
+def open_text(path, mode='rt'):
+    return gzip.open(path, mode, encoding='utf-8') if path.endswith('.gz') else open(path, mode, encoding='utf-8')
+
+
+class LineRanges:
+    """
+    a set of line numbers, stored as the sorted disjoint ranges [start, end) they form,
+    so it stays small when the queries complete roughly in order
+    """
+
+    def __init__(self) -> None:
+        self.starts = []
+        self.ends = []
+
+    def __contains__(self, i):
+        k = bisect.bisect_right(self.starts, i) - 1
+        return k >= 0 and i < self.ends[k]
+
+    def __len__(self):
+        return sum(end - start for start, end in zip(self.starts, self.ends))
+
+    def add_range(self, start, end):
+        # merged with the ranges it overlaps or touches
+        lo = bisect.bisect_left(self.ends, start)
+        hi = bisect.bisect_right(self.starts, end)
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+        self.starts[lo: hi] = [start]
+        self.ends[lo: hi] = [end]
+
+    def ranges(self) -> list:
+        return [[start, end] for start, end in zip(self.starts, self.ends)]
+
+
+def to_ranges(lines) -> list:
+    """
+    the sorted line numbers `lines`, as a list of ranges [start, end)
+    """
+    done = LineRanges()
+    for i in lines:
+        done.add_range(i, i + 1)
+    return done.ranges()
+
+
+def read_checkpoint(path) -> tuple:
+    """
+    the line numbers of the completed queries, the size of the output file at the last checkpoint,
+    and the size of the valid part of the checkpoint file
+    """
+    done = LineRanges()
+    offset = 0
+    size = 0
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('no end of line')
+                    chunk = json.loads(line)
+                except ValueError:
+                    break   # a partially written checkpoint, anything after it was not checkpointed
+                for start, end in chunk['lines']:
+                    done.add_range(start, end)
+                offset = chunk['offset']
+                size += len(line)
+    return done, offset, size
+
+
+def read_queries(path, done: LineRanges):
+    """
+    yields (line number, id, messages) for each query whose line number is not in `done`, streamed from the input file
+    """
+    with open_text(path) as f:
+        for i, line in enumerate(f):
+            if not line.strip() or i in done:
+                continue
+            query = json.loads(line)
+            query_id = query.get('id', i)
+            if 'messages' in query:
+                messages = query['messages']
+            else:
+                messages = [{'role': 'user', 'content': query['prompt']}]
+            yield i, query_id, messages
+
+
+def to_json(query_id, report: dict, perturbed=True) -> dict:
+    out = {'id': query_id, 'confidence': report['confidence'], 'outputs': report['outputs']}
+    if 'stderr' in report:
+        out['stderr'] = report['stderr']
+    if 'prompt_tokens' in report:
+        out['prompt_tokens'] = report['prompt_tokens']
+    if perturbed:
+        # the PerturbedMessages are materialized as plain lists of messages only here
+        out['perturbed'] = [[list(x), t] for x, t in report['perturbed']]
+    return out
+
+
+class ReportWriter:
+    """
+    append the reports to `path` in chunks, each compressed as one gzip member if `path` ends with .gz,
+    so the file stays readable after being cut off at any chunk boundary
+    """
+
+    def __init__(self, path, offset=0) -> None:
+        self.compress = path.endswith('.gz')
+        self.f = open(path, 'r+b' if os.path.exists(path) else 'wb')
+        self.f.truncate(offset)
+        self.f.seek(offset)
+
+    def write(self, reports: list) -> int:
+        data = ''.join(json.dumps(r) + '\n' for r in reports).encode('utf-8')
+        if self.compress:
+            data = gzip.compress(data)
+        self.f.write(data)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+
+def make_llms(args) -> tuple:
+    """
+    the target LLM, and the paraphraser (sharing the same backend, cache and `max_concurrency` bound)
+    """
+    if args.backend == 'fake':
+        backend = FakeBackend()
+    elif args.backend == 'local':
+        backend = LocalBackend(base_url=args.base_url or 'http://localhost:8000/v1', max_retries=args.max_retries)
+    else:
+        backend = OpenAIBackend(base_url=args.base_url, max_retries=args.max_retries)
+    cache = SQLiteResponseCache(args.cache) if args.cache else None
+    llm = LLM(args.model, max_concurrency=args.max_concurrency, cache=cache, seed=args.seed, backend=backend)
+    if args.paraphrase_model is None or args.paraphrase_model == args.model:
+        return llm, llm
+    paraphrase_llm = LLM(args.paraphrase_model, cache=cache, seed=args.seed, backend=backend)
+    paraphrase_llm.slots = llm.slots    # the requests of both count towards the same bound
+    return llm, paraphrase_llm
+
+
+def run(args):
+    checkpoint = args.checkpoint or args.out + '.ckpt'
+    if args.resume:
+        done, offset, size = read_checkpoint(checkpoint)
+        if os.path.exists(checkpoint):
+            # cut off a partially written checkpoint, so the next ones are not appended after it
+            os.truncate(checkpoint, size)
+    else:
+        done, offset = LineRanges(), 0
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    llm, paraphrase_llm = make_llms(args)
+    spuq = SPUQ(llm=llm, perturbation=args.perturbation, aggregation=args.aggregation, n_perturb=args.n_perturb,
+                max_workers=args.max_workers, paraphrase_llm=paraphrase_llm,
+                temperature_buckets=args.temperature_buckets, prompt_stats=args.prompt_stats)
+    kwargs = {} if args.threshold is None else {'threshold': args.threshold}
+
+    ids = {}    # index -> (line number, id), of the queries in progress only
+
+    def messages_list():
+        for i, (line, query_id, messages) in enumerate(read_queries(args.input, done)):
+            ids[i] = line, query_id
+            yield messages
+
+    writer = ReportWriter(args.out, offset)
+    n_done, n_failed = len(done), 0
+    chunk = []
+    lines = []  # the line numbers of the reports in `chunk`
+    try:
+        with open(checkpoint, 'a') as ckpt:
+
+            def flush():
+                if not chunk:
+                    return
+                offset = writer.write(chunk)
+                ckpt.write(json.dumps({'lines': to_ranges(sorted(lines)), 'offset': offset}) + '\n')
+                ckpt.flush()
+                os.fsync(ckpt.fileno())
+                chunk.clear()
+                lines.clear()
+
+            for i, report in spuq.run_many(messages_list(), args.temperature, max_queries=args.max_queries, **kwargs):
+                line, query_id = ids.pop(i)
+                if 'error' in report:
+                    n_failed += 1
+                    print('failed', query_id, report['error'], file=sys.stderr)
+                    continue
+                chunk.append(to_json(query_id, report, perturbed=not args.no_perturbed))
+                lines.append(line)
+                n_done += 1
+                if len(chunk) >= args.checkpoint_every:
+                    flush()
+                    print('done %i, failed %i'%(n_done, n_failed), file=sys.stderr)
+            flush()
+    finally:
+        writer.close()
+    print('done %i, failed %i'%(n_done, n_failed), file=sys.stderr)
+    return n_done, n_failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='run SPUQ over a JSONL file of queries')
+    parser.add_argument('input', help='JSONL (or .jsonl.gz) of {"id", "messages"} or {"id", "prompt"}')
+    parser.add_argument('--out', required=True, help='JSONL of the reports, gzip-compressed if it ends with .gz')
+    parser.add_argument('--checkpoint', help='default: OUT.ckpt')
+    parser.add_argument('--resume', action='store_true', help='skip the queries completed at the last checkpoint')
+    parser.add_argument('--checkpoint-every', type=int, default=100, help='number of reports per checkpoint')
+    parser.add_argument('--no-perturbed', action='store_true', help='do not write the perturbed messages')
+    parser.add_argument('--prompt-stats', action='store_true', help='write the estimated prompt tokens of each query')
+    parser.add_argument('--perturbation', default='paraphrasing', choices=PERTURBATIONS)
+    parser.add_argument('--aggregation', default='rougeL', choices=AGGREGATIONS)
+    parser.add_argument('--n-perturb', type=int, default=5)
+    parser.add_argument('--temperature', type=float, default=0.7)
+    parser.add_argument('--temperature-buckets', type=int,
+                        help='snap the perturbed temperatures to N buckets, so the equal ones share a request')
+    parser.add_argument('--threshold', type=float, help='early exit, see SPUQ.run')
+    parser.add_argument('--model', default='gpt-3.5-turbo-0301')
+    parser.add_argument('--paraphrase-model', help='default: MODEL')
+    parser.add_argument('--backend', default='openai', choices=['openai', 'local', 'fake'])
+    parser.add_argument('--base-url')
+    parser.add_argument('--max-retries', type=int, default=2)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--cache', help='SQLite file to cache the LLM responses')
+    parser.add_argument('--max-queries', type=int, default=8, help='number of queries in progress at a time')
+    parser.add_argument('--max-workers', type=int, default=1, help='LLM requests in flight per query')
+    parser.add_argument('--max-concurrency', type=int, help='LLM requests in flight in total')
+    args = parser.parse_args(argv)
+    return run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""
+benchmark the SPUQ pipeline stages against a fake LLM (see llms.FakeBackend), without network access.
+for each perturbation x aggregation x n_perturb x output length, it reports the wall time per stage
+(perturb, generate, aggregate), the throughput and the peak memory, and saves them as JSON.
+the fake LLM picks its outputs among `--responses` distinct ones, sharing about `--overlap` of their words.
+
+python benchmark.py --aggregation rougeL sbert --n-perturb 3 5 --output-length 20 200 --out bench_results.json
+python benchmark.py --compare bench_results.json    # flag the regressions against a previous run
+
+with --sbert-report, it compares the sbert embedders (model x backend, see text_sim._load_sbert) instead:
+the sbert confidences on a fixed corpus against the fp32 baseline (the first model), and the encoding throughput.
+
+python benchmark.py --sbert-report --sbert-models paraphrase-multilingual-mpnet-base-v2 all-MiniLM-L6-v2 \\
+    --sbert-backends torch int8 onnx --out sbert_report.json
+"""
+
+import argparse
+import json
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+import numpy as np
+from llms import LLM, FakeBackend
+from spuq import SPUQ, PERTURBATIONS, AGGREGATIONS
+from aggregation import InterSampleAggregation
+from text_sim import TextSimilarity, EmbeddingCache, SBERT_MODEL, SBERT_BACKENDS
+
+
+def make_responses(n: int, length: int, overlap=0.5, seed=0) -> list:
+    """
+    `n` synthetic outputs of `length` words, sharing about `overlap` of their words
+    """
+    rng = np.random.RandomState(seed)
+    vocab = ['word%i'%i for i in range(1000)]
+    common = list(rng.choice(vocab, length))
+    responses = []
+    for _ in range(n):
+        words = [w if rng.random_sample() < overlap else rng.choice(vocab) for w in common]
+        responses.append(' '.join(words) + '.')
+    return responses
+
+
+def make_messages(n_turns: int, turn_length: int, seed=0) -> list:
+    rng = np.random.RandomState(seed)
+    messages = []
+    for i in range(n_turns):
+        role = 'user' if i % 2 == 0 else 'assistant'
+        content = ' '.join('word%i'%w for w in rng.randint(0, 1000, turn_length))
+        messages.append({'role': role, 'content': content + '?'})
+    return messages
+
+
+def bench(perturbation: str, aggregation: str, n_perturb: int, output_length: int, args) -> dict:
+    backend = FakeBackend(responses=make_responses(args.responses, output_length, args.overlap), latency=args.latency)
+    llm = LLM(backend=backend)
+    # the fake paraphraser always returns n valid paraphrases
+    paraphrased = ['%s (paraphrase %i)'%(args.question, i) for i in range(n_perturb)]
+    paraphrase_llm = LLM(backend=FakeBackend(responses=[json.dumps({'paraphrased': paraphrased})], latency=args.latency))
+    spuq = SPUQ(llm=llm, perturbation=perturbation, aggregation=aggregation, n_perturb=n_perturb,
+                max_workers=args.max_workers, paraphrase_llm=paraphrase_llm)
+    if perturbation == 'paraphrasing':
+        spuq.perturbation.cache_size = 0    # measure the paraphrase call of every query
+
+    messages = make_messages(args.n_turns - 1, args.turn_length) + [{'role': 'user', 'content': args.question}]
+    timings = {'perturb': [], 'generate': [], 'aggregate': []}
+
+    def run_once():
+        t0 = time.perf_counter()
+        perturbed, diffs = spuq.perturb(messages, args.temperature)
+        t1 = time.perf_counter()
+        outs = spuq.llm.generate_many(perturbed, max_workers=spuq.max_workers)
+        t2 = time.perf_counter()
+        spuq.aggregation.aggregate([(x, out) for (x, _), out in zip(perturbed, outs)], diffs=diffs)
+        t3 = time.perf_counter()
+        return t1 - t0, t2 - t1, t3 - t2
+
+    run_once()  # warm up, e.g. load the models
+    t_start = time.perf_counter()
+    for _ in range(args.queries):
+        for stage, t in zip(timings, run_once()):
+            timings[stage].append(t)
+    wall = time.perf_counter() - t_start
+
+    # the peak memory of one more query, in a separate pass, so the timings do not include the tracing overhead
+    tracemalloc.start()
+    run_once()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'perturbation': perturbation,
+        'aggregation': aggregation,
+        'n_perturb': n_perturb,
+        'output_length': output_length,
+        'responses': args.responses,
+        'overlap': args.overlap,
+        'queries': args.queries,
+        'wall_time': wall,
+        'throughput': args.queries / wall,
+        'stages': {stage: {'mean': float(np.mean(ts)), 'p50': float(np.median(ts)), 'max': float(np.max(ts))}
+                   for stage, ts in timings.items()},
+        'peak_python_memory_mb': peak / 2 ** 20,
+        'llm_requests': backend.n_requests,
+    }
+
+
+# the outputs of a few queries, from consistent to contradicting, to compare the sbert confidences
+SBERT_CORPUS = [
+    ['Yes, 100 is greater than 3.', 'Yes.', 'Yes, it is.', '100 is greater than 3.', 'Indeed, 100 > 3.'],
+    ['Paris is the capital of France.', 'The capital of France is Paris.', 'Paris.', 'It is Paris.', 'Paris, France.'],
+    ['The Earth orbits the Sun.', 'The Sun orbits the Earth.', 'Both orbit their barycenter.', 'Yes.', 'I am not sure.'],
+    ['It depends on the context.', 'Yes.', 'No.', 'Maybe, it is unclear.', 'I cannot answer that.'],
+    ['Water boils at 100 degrees Celsius at sea level.', 'At sea level, 100 C.', '212 F, i.e. 100 C.',
+     'It boils at 90 degrees.', 'About 100 degrees Celsius.'],
+    ['The answer is 42.', 'It is 41.', 'Forty-two.', '42', 'I think 24.'],
+    ['Shakespeare wrote Hamlet.', 'Hamlet was written by William Shakespeare.', 'Marlowe wrote it.',
+     'William Shakespeare.', 'It was Shakespeare, around 1600.'],
+    ['No, whales are mammals.', 'Whales are not fish, they are mammals.', 'Yes, whales are fish.', 'No.',
+     'They are mammals.'],
+    ['Python is a programming language.', 'A snake.', 'It can be a snake or a programming language.',
+     'A language created by Guido van Rossum.', 'A large constricting snake.'],
+    ['The meeting is on Monday.', 'It is on Tuesday.', 'Monday morning.', 'Next week.', 'I do not know.'],
+]
+
+
+def rank_correlation(a, b) -> float:
+    # Spearman's rank correlation (without ties correction)
+    ra, rb = np.argsort(np.argsort(a)), np.argsort(np.argsort(b))
+    return float(np.corrcoef(ra, rb)[0, 1])
+
+
+def sbert_confidences(text_sim: TextSimilarity) -> np.ndarray:
+    agg = InterSampleAggregation('sbert', weighted=False, text_sim=text_sim)
+    inp = [{'role': 'user', 'content': ''}]
+    return np.array([agg.aggregate([(inp, out) for out in outs]) for outs in SBERT_CORPUS])
+
+
+def sbert_report(models: list, backends: list, args) -> list:
+    """
+    for each model x backend: the sbert confidences on SBERT_CORPUS against the fp32 baseline (`models[0]`, torch),
+    and the encoding throughput (texts / second, without the embedding cache)
+    """
+    texts = make_responses(args.queries * 8, 30)
+    baseline = None
+    configs = [(models[0], 'torch')] + [(m, b) for m in models for b in backends if (m, b) != (models[0], 'torch')]
+    results = []
+    for model, backend in configs:
+        config = {'sbert_model': model, 'sbert_backend': backend}
+        try:
+            text_sim = TextSimilarity(cache=EmbeddingCache(), sbert_model=model, sbert_backend=backend)
+            text_sim.embedder.encode(texts[:8])     # warm up
+        except ImportError as e:
+            print('skipped', model, backend, e)
+            results.append({**config, 'skipped': str(e)})
+            continue
+        t0 = time.perf_counter()
+        text_sim.embedder.encode(texts)
+        throughput = len(texts) / (time.perf_counter() - t0)
+        confs = sbert_confidences(text_sim)
+        if (model, backend) == configs[0]:
+            baseline = confs
+        result = {**config, 'throughput': throughput, 'confidences': confs.tolist()}
+        if baseline is not None:
+            result.update({
+                'mean_abs_diff': float(np.abs(confs - baseline).mean()),
+                'max_abs_diff': float(np.abs(confs - baseline).max()),
+                'rank_correlation': rank_correlation(confs, baseline),
+            })
+        results.append(result)
+        print('%-40s %-6s %8.1f texts/s'%(model, backend, throughput), '  |diff| mean %.4f max %.4f  rank corr %.3f'%(
+            result['mean_abs_diff'], result['max_abs_diff'], result['rank_correlation']) if baseline is not None else '')
+    return results
+
+
+def config_key(result: dict) -> tuple:
+    # the results saved before the responses and overlap were options used 8 and 0.5
+    return (result['perturbation'], result['aggregation'], result['n_perturb'], result['output_length'],
+            result.get('responses', 8), result.get('overlap', 0.5))
+
+
+_CONFIG_FORMAT = '%-16s %-16s n=%-3i len=%-5i responses=%-3i overlap=%.2f'
+
+
+def compare(results: list, baseline_path: str, tolerance: float) -> list:
+    """
+    the configs whose wall time per query got slower than the baseline by more than `tolerance` (relative)
+    """
+    with open(baseline_path) as f:
+        baseline = {config_key(r): r for r in json.load(f)['results'] if 'wall_time' in r}
+    regressions = []
+    for r in results:
+        b = baseline.get(config_key(r))
+        if b is None or 'wall_time' not in r:
+            continue
+        ratio = (r['wall_time'] / r['queries']) / (b['wall_time'] / b['queries'])
+        print((_CONFIG_FORMAT + ' %.2fx')%(config_key(r) + (ratio,)))
+        if ratio > 1 + tolerance:
+            regressions.append(config_key(r))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the SPUQ pipeline stages against a fake LLM')
+    parser.add_argument('--perturbation', nargs='+', default=PERTURBATIONS, choices=PERTURBATIONS)
+    parser.add_argument('--aggregation', nargs='+', default=['rouge1', 'rouge2', 'rougeL', 'verbalized_num'],
+                        choices=AGGREGATIONS)
+    parser.add_argument('--n-perturb', nargs='+', type=int, default=[3, 5])
+    parser.add_argument('--output-length', nargs='+', type=int, default=[20, 200], help='in words')
+    parser.add_argument('--responses', type=int, default=8, help='number of distinct outputs of the fake LLM')
+    parser.add_argument('--overlap', type=float, default=0.5, help='fraction of the words shared by the outputs')
+    parser.add_argument('--queries', type=int, default=10, help='number of queries per config')
+    parser.add_argument('--latency', type=float, default=0., help='fake LLM latency per request, in seconds')
+    parser.add_argument('--max-workers', type=int, default=1)
+    parser.add_argument('--n-turns', type=int, default=1, help='number of turns of the conversation')
+    parser.add_argument('--turn-length', type=int, default=50, help='in words, for the turns before the question')
+    parser.add_argument('--question', default='Is 100 greater than 3?')
+    parser.add_argument('--temperature', type=float, default=0.7)
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--compare', help='a previous output of this script, to flag the regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--sbert-report', action='store_true', help='compare the sbert embedders instead')
+    parser.add_argument('--sbert-models', nargs='+', default=[SBERT_MODEL], help='the first one is the baseline')
+    parser.add_argument('--sbert-backends', nargs='+', default=SBERT_BACKENDS, choices=SBERT_BACKENDS)
+    args = parser.parse_args()
+
+    if args.sbert_report:
+        results = sbert_report(args.sbert_models, args.sbert_backends, args)
+        with open(args.out, 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'args': vars(args), 'results': results}, f, indent=2)
+        print('saved to', args.out)
+        return
+
+    results = []
+    for perturbation in args.perturbation:
+        for aggregation in args.aggregation:
+            for n_perturb in args.n_perturb:
+                for output_length in args.output_length:
+                    try:
+                        result = bench(perturbation, aggregation, n_perturb, output_length, args)
+                    except ImportError as e:
+                        # e.g. sbert or bertscore without their dependencies installed
+                        result = {'perturbation': perturbation, 'aggregation': aggregation, 'n_perturb': n_perturb,
+                                  'output_length': output_length, 'responses': args.responses,
+                                  'overlap': args.overlap, 'skipped': str(e)}
+                        print('skipped', config_key(result), e)
+                        results.append(result)
+                        continue
+                    results.append(result)
+                    stages = ' '.join('%s %.2fms'%(stage, 1e3 * t['mean']) for stage, t in result['stages'].items())
+                    print((_CONFIG_FORMAT + ' %.1f q/s  %s  peak %.2fMB')%(
+                        config_key(result) + (result['throughput'], stages, result['peak_python_memory_mb'])))
+
+    with open(args.out, 'w') as f:
+        json.dump({
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10,
+            'args': vars(args),
+            'results': results,
+        }, f, indent=2)
+    print('saved to', args.out)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        if regressions:
+            print('regressions (> %.0f%% slower):'%(100 * args.tolerance), regressions)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
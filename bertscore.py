@@ -0,0 +1,137 @@
+"""
+a resident BERTScore engine returning the same F1 as `evaluate.load('bertscore').compute(..., lang=lang)`
+(i.e. `bert_score.score` without idf nor baseline rescaling), but faster:
+* the model and tokenizer are loaded once, and kept
+* the contextual token embeddings of each text are computed once (and cached), in padded batches
+* the greedy matching of one reference against many candidates is one batched tensor operation
+"""
+
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class TokenEmbeddings:
+    """
+    the L2-normalized contextual embeddings of the tokens of a text, and their weights:
+    as in bert_score (without idf), the [CLS] and [SEP] tokens are matched but weigh 0
+    """
+
+    def __init__(self, emb, wt) -> None:
+        self.emb = emb  # (n_tokens, dim)
+        self.wt = wt    # (n_tokens,)
+
+    def __len__(self):
+        return self.emb.shape[0]
+
+
+class BertScoreEngine:
+    """
+    `score_batch(target, predictions)` matches
+    `bert_score.score(predictions, [target] * len(predictions), lang=lang)` F1, on CPU by default.
+    `num_threads` sets the number of torch CPU threads (process-wide)
+    """
+
+    def __init__(self, lang='en', model_type=None, num_layers=None, device='cpu', num_threads=None,
+                 batch_size=64, max_size=10000) -> None:
+        import torch
+        from bert_score import utils
+        self.torch = torch
+        self.utils = utils
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        self.model_type = model_type if model_type is not None else utils.lang2model[lang.lower()]
+        self.num_layers = num_layers if num_layers is not None else utils.model2layers[self.model_type]
+        self.tokenizer = utils.get_tokenizer(self.model_type, use_fast=False)
+        self.model = utils.get_model(self.model_type, self.num_layers)
+        self.model.eval()
+        self.model.to(device)
+        self.device = device
+        self.batch_size = batch_size
+        self.special = {self.tokenizer.sep_token_id, self.tokenizer.cls_token_id}
+
+        self.max_size = max_size
+        self.cache = OrderedDict()   # text -> TokenEmbeddings
+        self.lock = threading.Lock()
+        self.model_lock = threading.Lock()
+
+
+    def _encode(self, texts: list) -> list:
+        torch = self.torch
+        ids = [self.utils.sent_encode(self.tokenizer, t) for t in texts]
+        out = []
+        # sorted by length, so each batch is padded as little as possible
+        order = sorted(range(len(texts)), key=lambda i: len(ids[i]))
+        embs = {}
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start: start + self.batch_size]
+            max_len = max(len(ids[i]) for i in batch)
+            x = torch.full((len(batch), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+            mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+            for row, i in enumerate(batch):
+                x[row, :len(ids[i])] = torch.tensor(ids[i], dtype=torch.long)
+                mask[row, :len(ids[i])] = 1
+            with self.model_lock:
+                emb = self.utils.bert_encode(self.model, x.to(self.device), attention_mask=mask.to(self.device))
+            emb = emb.float().cpu()
+            for row, i in enumerate(batch):
+                e = emb[row, :len(ids[i])]
+                embs[i] = e / e.norm(dim=-1, keepdim=True)
+        for i, t in enumerate(texts):
+            wt = torch.tensor([0. if token in self.special else 1. for token in ids[i]])
+            out.append(TokenEmbeddings(embs[i], wt))
+        return out
+
+
+    def embeddings(self, texts: list) -> list:
+        """
+        the token embeddings of `texts`, each unique text is encoded only once, and only if it is not cached yet
+        """
+        found = {}
+        with self.lock:
+            for t in texts:
+                if t in self.cache:
+                    self.cache.move_to_end(t)
+                    found[t] = self.cache[t]
+        missing = [t for t in dict.fromkeys(texts) if t not in found]
+        if missing:
+            encoded = self._encode(missing)
+            with self.lock:
+                for t, e in zip(missing, encoded):
+                    self.cache[t] = found[t] = e
+                while len(self.cache) > self.max_size:
+                    self.cache.popitem(last=False)
+        return [found[t] for t in texts]
+
+
+    def score_batch(self, target: str, predictions: list) -> np.ndarray:
+        """
+        the F1 of each of the `predictions` against the `target`, by greedy matching of the token embeddings
+        """
+        if not predictions:
+            return np.zeros(0)
+        torch = self.torch
+        ref, *hyps = self.embeddings([target] + list(predictions))
+
+        max_len = max(len(h) for h in hyps)
+        hyp_emb = torch.zeros((len(hyps), max_len, ref.emb.shape[-1]))
+        hyp_mask = torch.zeros((len(hyps), max_len))
+        hyp_wt = torch.zeros((len(hyps), max_len))
+        for i, h in enumerate(hyps):
+            hyp_emb[i, :len(h)] = h.emb
+            hyp_mask[i, :len(h)] = 1.
+            hyp_wt[i, :len(h)] = h.wt
+
+        # (n_predictions, prediction tokens, target tokens), the padding is masked to 0 as in bert_score
+        sim = torch.matmul(hyp_emb, ref.emb.T) * hyp_mask.unsqueeze(-1)
+        word_precision = sim.max(dim=2)[0]
+        word_recall = sim.max(dim=1)[0]
+        P = (word_precision * hyp_wt).sum(dim=1) / hyp_wt.sum(dim=1).clamp(min=1e-12)
+        R = (word_recall * ref.wt).sum(dim=1) / ref.wt.sum().clamp(min=1e-12)
+        F = 2 * P * R / (P + R)
+        return torch.nan_to_num(F, nan=0.).numpy().astype(np.float64)
+
+
+    def score(self, target: str, prediction: str) -> float:
+        return float(self.score_batch(target, [prediction])[0])
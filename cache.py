@@ -0,0 +1,142 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheMiss(KeyError):
+    """
+    raised in replay mode, when a response is not found in the cache
+    """
+
+
+class ResponseCache:
+    """
+    memoize the LLM responses, keyed on (model, messages, temperature, seed, sample)
+    * ttl: entries older than `ttl` seconds are treated as missing
+    * max_entries: the least recently used entries are evicted beyond this size
+    * replay: strict mode, a miss raises CacheMiss instead of calling the LLM,
+    so a fixed set of generations can be replayed offline
+
+    this one keeps the responses in memory, see SQLiteResponseCache for a persistent backend.
+    a custom backend only needs to override `_get`, `_put` and `__len__`
+    """
+
+    def __init__(self, ttl=None, max_entries=None, replay=False) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.replay = replay
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()   # key -> (response, created)
+
+
+    @staticmethod
+    def key(model: str, messages: list, temperature: float, seed=None, sample=0) -> str:
+        """
+        `sample` tells apart the repeated requests of the same (messages, temperature),
+        so that they are not collapsed into one response
+        """
+        s = json.dumps([model, messages, temperature, seed, sample], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+
+    def get(self, key: str):
+        """
+        return the cached response, or None if it is missing (or expired)
+        """
+        with self.lock:
+            out = self._get(key, None if self.ttl is None else time.time() - self.ttl)
+            if out is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return out
+
+
+    def put(self, key: str, response: str):
+        with self.lock:
+            self._put(key, response, time.time())
+
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self),
+            }
+
+
+    def _get(self, key, min_created):
+        if key not in self.entries:
+            return None
+        response, created = self.entries[key]
+        if min_created is not None and created < min_created:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return response
+
+
+    def _put(self, key, response, created):
+        self.entries[key] = (response, created)
+        self.entries.move_to_end(key)
+        while self.max_entries is not None and len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SQLiteResponseCache(ResponseCache):
+    """
+    ResponseCache persisted in a local SQLite file, shared across runs
+    """
+
+    def __init__(self, path='spuq_cache.sqlite', ttl=None, max_entries=None, replay=False) -> None:
+        super().__init__(ttl, max_entries, replay)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses '
+            '(key TEXT PRIMARY KEY, response TEXT, created REAL, used REAL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        self.conn.commit()
+
+
+    def _get(self, key, min_created):
+        row = self.conn.execute('SELECT response, created FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        response, created = row
+        if min_created is not None and created < min_created:
+            self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.conn.commit()
+            return None
+        self.conn.execute('UPDATE responses SET used = ? WHERE key = ?', (time.time(), key))
+        self.conn.commit()
+        return response
+
+
+    def _put(self, key, response, created):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO responses (key, response, created, used) VALUES (?, ?, ?, ?)',
+            (key, response, created, created),
+        )
+        if self.max_entries is not None:
+            self.conn.execute(
+                'DELETE FROM responses WHERE key IN '
+                '(SELECT key FROM responses ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,),
+            )
+        self.conn.commit()
+
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
@@ -1,18 +1,391 @@
 import os
-from openai import OpenAI
+import json
+import time
+import asyncio
+import hashlib
+import threading
+import weakref
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from openai import OpenAI, AsyncOpenAI
+from cache import ResponseCache, CacheMiss
+import tracing
+
+
+def materialize(messages) -> list:
+    # the perturbed messages (see perturbation.PerturbedMessages) only become plain lists of dicts here,
+    # at the boundary with the backends (and the response cache)
+    return messages.materialize() if hasattr(messages, 'materialize') else messages
+
+
+class Backend:
+    """
+    the interface of an LLM backend: generate `n` outputs for one chat request.
+    `json_mode` asks for a JSON object output, for the backends that support it.
+    `agenerate` is the asyncio version, by default it runs `generate` in a thread.
+    """
+
+    def generate(self, model: str, messages: list, temperature: float, n=1, seed=None, json_mode=False) -> list:
+        raise NotImplementedError
+
+    async def agenerate(self, model: str, messages: list, temperature: float, n=1, seed=None, json_mode=False) -> list:
+        return await asyncio.to_thread(self.generate, model, messages, temperature, n, seed, json_mode)
+
+
+# one client per endpoint, shared by the whole process,
+# so all the LLM (and Paraphrasing) instances reuse the same pool of keep-alive connections.
+# the connections of an async client are bound to the event loop that opened them, so there is one per loop
+_clients = {}
+_async_clients = weakref.WeakKeyDictionary()    # event loop -> {key: client}
+_clients_lock = threading.Lock()
+
+
+def _on_request(request):
+    # one per attempt, so the retries are the HTTP requests in excess of the `llm.generate` spans
+    tracing.count('llm.http_request')
+
+
+async def _aon_request(request):
+    _on_request(request)
+
+
+def shared_client(base_url=None, api_key=None, max_retries=2, max_connections=100, asynchronous=False):
+    """
+    the async clients are shared per running event loop, so `asynchronous=True` must be called from a coroutine
+    """
+    key = (base_url, api_key, max_retries, max_connections)
+    with _clients_lock:
+        clients = _async_clients.setdefault(asyncio.get_running_loop(), {}) if asynchronous else _clients
+        if key not in clients:
+            limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+            if asynchronous:
+                clients[key] = AsyncOpenAI(
+                    base_url=base_url, api_key=api_key, max_retries=max_retries,
+                    http_client=httpx.AsyncClient(limits=limits, timeout=600, event_hooks={'request': [_aon_request]}),
+                )
+            else:
+                clients[key] = OpenAI(
+                    base_url=base_url, api_key=api_key, max_retries=max_retries,
+                    http_client=httpx.Client(limits=limits, timeout=600, event_hooks={'request': [_on_request]}),
+                )
+        return clients[key]
+
+
+class OpenAIBackend(Backend):
+    """
+    the OpenAI chat completions API, or any OpenAI-compatible endpoint given by `base_url`.
+    the client retries rate-limited (429) and failed requests with exponential backoff,
+    honoring the `retry-after` header sent by the API
+    """
+
+    def __init__(self, base_url=None, api_key=None, max_retries=2, max_connections=100) -> None:
+        self.base_url = base_url
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.max_connections = max_connections
+
+    def _client(self, asynchronous=False):
+        api_key = self.api_key if self.api_key is not None else os.environ.get("OPENAI_API_KEY")
+        return shared_client(self.base_url, api_key, self.max_retries, self.max_connections, asynchronous)
+
+    def _kwargs(self, model, messages, temperature, n, seed, json_mode):
+        kwargs = {} if seed is None else {'seed': seed}
+        if json_mode:
+            kwargs['response_format'] = {'type': 'json_object'}
+        return dict(messages=messages, temperature=temperature, model=model, n=n, **kwargs)
+
+    def _outputs(self, ret):
+        if ret.usage is not None:
+            tracing.count('llm.prompt_tokens', ret.usage.prompt_tokens)
+            tracing.count('llm.completion_tokens', ret.usage.completion_tokens)
+        return [choice.message.content for choice in sorted(ret.choices, key=lambda choice: choice.index)]
+
+    # an OpenAI-compatible endpoint may ignore `n` (e.g. the llama.cpp server) and return fewer choices,
+    # the missing outputs are then generated by as many single requests
+
+    def generate(self, model, messages, temperature, n=1, seed=None, json_mode=False) -> list:
+        create = self._client().chat.completions.create
+        outs = self._outputs(create(**self._kwargs(model, messages, temperature, n, seed, json_mode)))
+        for _ in range(n - len(outs)):
+            outs += self._outputs(create(**self._kwargs(model, messages, temperature, 1, seed, json_mode)))[:1]
+        return outs
+
+    async def agenerate(self, model, messages, temperature, n=1, seed=None, json_mode=False) -> list:
+        create = self._client(asynchronous=True).chat.completions.create
+        outs = self._outputs(await create(**self._kwargs(model, messages, temperature, n, seed, json_mode)))
+        if len(outs) < n:
+            rets = await asyncio.gather(*[create(**self._kwargs(model, messages, temperature, 1, seed, json_mode))
+                                          for _ in range(n - len(outs))])
+            outs += [out for ret in rets for out in self._outputs(ret)[:1]]
+        return outs
+
+
+class LocalBackend(OpenAIBackend):
+    """
+    a locally served model behind an OpenAI-compatible endpoint (e.g. vLLM, llama.cpp server)
+    """
+
+    def __init__(self, base_url='http://localhost:8000/v1', api_key='EMPTY', max_retries=2, max_connections=100) -> None:
+        super().__init__(base_url, api_key, max_retries, max_connections)
+
+
+class FakeBackend(Backend):
+    """
+    a deterministic in-process LLM, for testing and benchmarking without network access.
+    the output is picked from `responses` by hashing the request, so the same sequence of requests
+    always gets the same outputs. at temperature 0, the same messages always get the same output.
+    `latency` (seconds) is slept per request.
+    """
+
+    def __init__(self, responses=None, latency=0., seed=0) -> None:
+        self.responses = responses or [
+            'Yes.',
+            'Yes, it is.',
+            'No, it is not.',
+            'It depends.',
+            'I am not sure.',
+        ]
+        self.latency = latency
+        self.seed = seed
+        self.counts = Counter()    # calls per request, so repeated requests can get different outputs
+        self.n_requests = 0
+        self.lock = threading.Lock()
+
+    def _pick(self, messages, temperature, i):
+        s = json.dumps([self.seed, messages, temperature if temperature > 0 else 0, i], sort_keys=True)
+        h = int(hashlib.md5(s.encode('utf-8')).hexdigest(), 16)
+        return self.responses[h % len(self.responses)]
+
+    def _generate(self, messages, temperature, n):
+        key = json.dumps([messages, temperature], sort_keys=True)
+        with self.lock:
+            self.n_requests += 1
+            start = self.counts[key]
+            self.counts[key] += n
+        if temperature <= 0:
+            return [self._pick(messages, 0, 0)] * n
+        return [self._pick(messages, temperature, start + i) for i in range(n)]
+
+    def generate(self, model, messages, temperature, n=1, seed=None, json_mode=False) -> list:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return self._generate(messages, temperature, n)
+
+    async def agenerate(self, model, messages, temperature, n=1, seed=None, json_mode=False) -> list:
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        return self._generate(messages, temperature, n)
+
+
+class Slots:
+    """
+    at most `n` requests in flight, across the threads (`acquire`) and the event loops (`aacquire`) sharing it.
+    the coroutines wait on their event loop, without holding a thread, and the slots are handed over in FIFO order
+    """
+
+    def __init__(self, n: int) -> None:
+        assert(n > 0)
+        self.free = n
+        self.lock = threading.Lock()
+        self.waiters = deque()  # threading.Event (a thread) or asyncio.Future (a coroutine)
+
+    def acquire(self):
+        with self.lock:
+            if self.free and not self.waiters:
+                self.free -= 1
+                return
+            event = threading.Event()
+            self.waiters.append(event)
+        event.wait()    # the slot is handed over by `release`
+
+    async def aacquire(self):
+        with self.lock:
+            if self.free and not self.waiters:
+                self.free -= 1
+                return
+            fut = asyncio.get_running_loop().create_future()
+            self.waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            with self.lock:
+                if fut in self.waiters:
+                    self.waiters.remove(fut)
+                    raise
+            if not fut.cancelled():
+                self.release()  # cancelled after the slot was handed over
+            # otherwise the slot is handed over to the next waiter by `_wake`
+            raise
+
+    def _wake(self, fut):
+        if fut.cancelled():
+            self.release()
+        else:
+            fut.set_result(None)
+
+    def release(self):
+        with self.lock:
+            while self.waiters:
+                waiter = self.waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                try:
+                    waiter.get_loop().call_soon_threadsafe(self._wake, waiter)
+                    return
+                except RuntimeError:
+                    pass    # its event loop is closed
+            self.free += 1
 
 
 class LLM:
-    def __init__(self, model='gpt-3.5-turbo-0301'):
-        self.client = OpenAI(
-            api_key=os.environ.get("OPENAI_API_KEY"),
-        )
+    def __init__(self, model='gpt-3.5-turbo-0301', max_retries=2, max_concurrency=None,
+                 cache: ResponseCache = None, seed=None, backend: Backend = None, json_mode=False):
+        # by default, the OpenAI API (with a client shared by the whole process)
+        self.backend = backend if backend is not None else OpenAIBackend(max_retries=max_retries)
         self.model = model
+        # bound the number of requests in flight, across all the threads and coroutines sharing this LLM
+        self.slots = Slots(max_concurrency) if max_concurrency else None
+        self.cache = cache
+        self.seed = seed
+        self.json_mode = json_mode    # ask for JSON outputs (response_format), if the model supports it
+
+    def generate(self, messages, temperature, sample=0):
+        """
+        `sample` is the index of this request among the identical (messages, temperature) requests,
+        it is only used as part of the cache key
+        """
+        return self.generate_n(messages, temperature, 1, sample=sample)[0]
+
+
+    async def agenerate(self, messages, temperature, sample=0):
+        return (await self.agenerate_n(messages, temperature, 1, sample=sample))[0]
+
+
+    def _from_cache(self, messages, temperature, n, sample):
+        outs = [None] * n
+        keys = None
+        if self.cache is not None:
+            keys = [self.cache.key(self.model, messages, temperature, self.seed, sample + i) for i in range(n)]
+            outs = [self.cache.get(key) for key in keys]
+            missing = [i for i, out in enumerate(outs) if out is None]
+            tracing.count('llm.cache_hit', n - len(missing))
+            tracing.count('llm.cache_miss', len(missing))
+            if missing and self.cache.replay:
+                raise CacheMiss(keys[missing[0]])
+        return outs, keys
+
+
+    def _to_cache(self, outs, keys, generated):
+        missing = [i for i, out in enumerate(outs) if out is None]
+        for i, out in zip(missing, generated):
+            outs[i] = out
+            if self.cache is not None and out is not None:
+                self.cache.put(keys[i], out)
+        return outs
+
+
+    def generate_n(self, messages, temperature, n, sample=0) -> list:
+        """
+        generate `n` outputs for the same (messages, temperature) in a single request,
+        so the prompt tokens are only sent (and paid for) once.
+        `sample` is the index of the first of them among the identical requests, see `generate`
+        """
+        messages = materialize(messages)
+        outs, keys = self._from_cache(messages, temperature, n, sample)
+        n_missing = outs.count(None)
+        if not n_missing:
+            return outs
+        if self.slots is not None:
+            self.slots.acquire()
+        try:
+            with tracing.span('llm.generate', model=self.model, n=n_missing):
+                generated = self.backend.generate(self.model, messages, temperature, n=n_missing, seed=self.seed,
+                                                  json_mode=self.json_mode)
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+        return self._to_cache(outs, keys, generated)
+
+
+    async def agenerate_n(self, messages, temperature, n, sample=0) -> list:
+        """
+        the asyncio version of `generate_n`
+        """
+        messages = materialize(messages)
+        outs, keys = self._from_cache(messages, temperature, n, sample)
+        n_missing = outs.count(None)
+        if not n_missing:
+            return outs
+        if self.slots is not None:
+            await self.slots.aacquire()
+        try:
+            with tracing.span('llm.generate', model=self.model, n=n_missing):
+                generated = await self.backend.agenerate(self.model, messages, temperature, n=n_missing, seed=self.seed,
+                                                         json_mode=self.json_mode)
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+        return self._to_cache(outs, keys, generated)
+
+
+    def _group(self, perturbed, seen):
+        # the pairs sharing the same messages (object) and temperature are generated together
+        groups = {}
+        for i, (x, t) in enumerate(perturbed):
+            groups.setdefault((id(x), t), []).append(i)
+        jobs = []
+        for ii in groups.values():
+            x, t = perturbed[ii[0]]
+            if self.cache is None:
+                jobs.append((x, t, len(ii), 0))     # `sample` is only part of the cache key
+                continue
+            # the samples are counted by content, as the cache keys are: equal messages in distinct objects
+            # (e.g. the originals repeated when paraphrasing fails) are distinct samples, not the same cached one
+            k = json.dumps([materialize(x), t], sort_keys=True, ensure_ascii=False)
+            jobs.append((x, t, len(ii), seen[k]))
+            seen[k] += len(ii)
+        return list(groups.values()), jobs
+
+
+    def _scatter(self, n, groups, results):
+        outs = [None] * n
+        for ii, group_outs in zip(groups, results):
+            for i, out in zip(ii, group_outs):
+                outs[i] = out
+        return outs
+
+
+    def generate_many(self, perturbed: list, max_workers=1, seen: Counter = None) -> list:
+        """
+        generate one output for each (messages, temperature) pair.
+        the pairs sharing the same messages (object) and temperature, e.g. from `Perturbation`,
+        are sent as one multi-sample request, see `generate_n`.
+        up to `max_workers` requests are in flight at the same time,
+        and the outputs are returned in the same order as `perturbed`.
+        `seen` counts the requests already made by the previous calls of the same run, if any
+        """
+        groups, jobs = self._group(perturbed, Counter() if seen is None else seen)
+        if max_workers <= 1 or len(jobs) <= 1:
+            results = [self.generate_n(x, t, n, sample=sample) for x, t, n, sample in jobs]
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as pool:
+                futures = [pool.submit(tracing.bind(self.generate_n), x, t, n, sample=sample) for x, t, n, sample in jobs]
+                results = [fut.result() for fut in futures]
+        return self._scatter(len(perturbed), groups, results)
+
+
+    async def agenerate_many(self, perturbed: list, max_workers=1, seen: Counter = None) -> list:
+        """
+        the asyncio version of `generate_many`
+        """
+        groups, jobs = self._group(perturbed, Counter() if seen is None else seen)
+        sem = asyncio.Semaphore(max_workers)
+
+        async def run(x, t, n, sample):
+            async with sem:
+                return await self.agenerate_n(x, t, n, sample=sample)
 
-    def generate(self, messages, temperature):
-        ret = self.client.chat.completions.create(
-            messages=messages,
-            temperature=temperature,
-            model=self.model,
-        )
-        return ret.choices[0].message.content
+        results = await asyncio.gather(*[run(*job) for job in jobs])
+        return self._scatter(len(perturbed), groups, results)
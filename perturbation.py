@@ -1,19 +1,91 @@
 import numpy as np
 import json, pdb
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
 from llms import LLM
-from copy import deepcopy
+import tracing
+
+
+class PerturbedMessages(Sequence):
+    """
+    a perturbed version of `messages`, without copying them:
+    the original messages are shared (so they must not be modified afterwards),
+    with an optional system message inserted before them (or before the last message, if `system_tail`),
+    and an optional new content for the last message.
+    it reads like the list of message dicts, and `materialize()` builds that plain list,
+    which is only done at the LLM backend boundary.
+    """
+    __slots__ = ('messages', 'system', 'last_content', 'system_tail')
+
+    def __init__(self, messages, system=None, last_content=None, system_tail=False) -> None:
+        self.messages = messages
+        self.system = system
+        self.last_content = last_content
+        self.system_tail = system_tail
+
+    def __len__(self):
+        return len(self.messages) + (self.system is not None)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.materialize()[i]
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('PerturbedMessages index out of range')
+        if self.system is not None:
+            system_i = len(self.messages) - 1 if self.system_tail else 0
+            if i == system_i:
+                return {'role': 'system', 'content': self.system}
+            if i > system_i:
+                i -= 1
+        if self.last_content is not None and i == len(self.messages) - 1:
+            return dict(self.messages[i], content=self.last_content)
+        return self.messages[i]
+
+    def materialize(self) -> list:
+        """
+        the plain list of message dicts, the unchanged messages are shared with the original list
+        """
+        x = list(self.messages)
+        if self.last_content is not None:
+            x[-1] = dict(x[-1], content=self.last_content)
+        if self.system is not None:
+            x.insert(len(x) - 1 if self.system_tail else 0, {'role': 'system', 'content': self.system})
+        return x
+
+    def __eq__(self, other):
+        if isinstance(other, (list, PerturbedMessages)):
+            return self.materialize() == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(self.materialize())
 
 
 class Perturbation:
     """
     the (messages, temperature) is perturbed to get n variants
+
+    `perturb_with_diff` also describes how each variant differs from the original messages:
+    * {'kind': 'same'}: the messages are not perturbed
+    * {'kind': 'system', 'content': str, 'tail': bool}: a system message is inserted before the messages,
+      or before the last message if `tail`
+    * {'kind': 'last', 'content': str}: the content of the last message is replaced
+    * {'kind': 'affix', 'prefix': str, 'suffix': str}: the content of the last message is prefixed/suffixed
+    so the aggregation can weight the variants without re-scoring the whole conversation
     """
     
     def __init__(self, n) -> None:
         self.n = n
 
     def perturb(self, messages, temperature) -> list:
-        return [(messages, temperature)] * self.n
+        return [(x, t) for x, t, _ in self.perturb_with_diff(messages, temperature)]
+
+    def perturb_with_diff(self, messages, temperature) -> list:
+        return [(messages, temperature, {'kind': 'same'})] * self.n
 
 
 class TemperaturePerturbation(Perturbation):
@@ -21,19 +93,28 @@ class TemperaturePerturbation(Perturbation):
     The temperature is perturbed with a random change,
     by sampling in the range (T_min, T_max)
     The prompt is not perturbed
+
+    if `n_buckets` is given, the sampled temperatures are snapped to the centers of
+    `n_buckets` equal-width buckets, so the variants in the same bucket are identical
+    and can be generated together in a single multi-sample (n=) request
     """
     
-    def __init__(self, n, T_min=0, T_max=1.,) -> None:
+    def __init__(self, n, T_min=0, T_max=1., n_buckets=None) -> None:
         self.T_min = T_min
         self.T_max = T_max
         self.n = n
+        assert(n_buckets is None or n_buckets > 0)
+        self.n_buckets = n_buckets
 
 
-    def perturb(self, messages: list, temperature: float) -> list:
+    def perturb_with_diff(self, messages: list, temperature: float) -> list:
         perturbed = []
         for _ in range(self.n):
-            temperature = self.T_min + np.random.random() * (self.T_max - self.T_min)
-            perturbed.append((messages, temperature))
+            r = np.random.random()
+            if self.n_buckets is not None:
+                r = (int(r * self.n_buckets) + 0.5) / self.n_buckets
+            temperature = self.T_min + r * (self.T_max - self.T_min)
+            perturbed.append((messages, temperature, {'kind': 'same'}))
         return perturbed
 
 
@@ -41,48 +122,96 @@ class TemperaturePerturbation(Perturbation):
 class Paraphrasing(Perturbation):
     """
     The prompt is perturbed by being paraphrased using ChatGPT (3.5).
+
+    the paraphraser can be any (e.g. a cheaper) `llm`, by default LLM('gpt-3.5-turbo-0301').
+    the paraphrases are cached per (prompt, n, paraphraser model), so a repeated prompt skips the LLM call.
+    if fewer than n valid paraphrases come back, the missing ones are requested again (up to `max_retries` times),
+    and if still missing, the original prompt is used in their place.
     """
 
-    def __init__(self, n: int) -> None:
+    def __init__(self, n: int, llm: LLM = None, max_retries=2, cache_size=1000) -> None:
         self.n = n
-        self.llm = LLM()
+        self.llm = llm if llm is not None else LLM()
+        self.cmd = self.command(n)
+        self.max_retries = max_retries
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # (prompt, n, model) -> paraphrases
+        self.lock = threading.Lock()
+
+
+    def command(self, n: int) -> str:
         cmd = 'Suggest %i ways to paraphrase the text in triple quotes above.'%n
         cmd += '\nIf the original text is a question, please make sure that the your answers are also questions.'
         cmd += '\nProvide your response in JSON format: {"paraphrased":list_of_str}'
-        self.cmd = cmd
-        
+        return cmd
 
-    def paraphrase(self, messages: list) -> list:
-        orig = messages[-1]['content']  # only perturb the last message
 
-        out = self.llm.generate([
-            {'role': 'user', 'content': '"""\n' + orig + '\n"""\n' + self.cmd}
-        ], temperature=0.7)
-        if out is None:
-            return None
+    @staticmethod
+    def parse(out: str) -> list:
+        """
+        the paraphrases in the first JSON object of `out` with a "paraphrased" list of strings
+        """
+        if not out:
+            return []
+        decoder = json.JSONDecoder()
         t0 = out.find('{')
-        if t0 < 0:
-            return None
-        t1 = out.find('}')
-        if t1 < t0:
-            return None
-        try:
-            paraphrased = json.loads(out[t0: t1 + 1])['paraphrased']
-        except:
-            return None
+        while t0 >= 0:
+            try:
+                obj, _ = decoder.raw_decode(out, t0)
+            except ValueError:
+                obj = None
+            if isinstance(obj, dict) and isinstance(obj.get('paraphrased'), list):
+                return [p.strip() for p in obj['paraphrased'] if isinstance(p, str) and p.strip()]
+            t0 = out.find('{', t0 + 1)
+        return []
+
+
+    def paraphrases(self, orig: str) -> list:
+        """
+        `n` paraphrases of the text `orig`
+        """
+        key = (orig, self.n, self.llm.model)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                tracing.count('paraphrase.cache_hit')
+                return self.cache[key]
+
+        paraphrased = []
+        for attempt in range(1 + self.max_retries):
+            k = self.n - len(paraphrased)
+            out = self.llm.generate([
+                {'role': 'user', 'content': '"""\n' + orig + '\n"""\n' + self.command(k)}
+            ], temperature=0.7, sample=attempt)
+            for p in self.parse(out):
+                if p not in paraphrased and len(paraphrased) < self.n:
+                    paraphrased.append(p)
+            if len(paraphrased) == self.n:
+                break
+        else:
+            tracing.count('paraphrase.fallback', self.n - len(paraphrased))
+            return paraphrased + [orig] * (self.n - len(paraphrased))   # not cached, to try again next time
+
+        with self.lock:
+            self.cache[key] = paraphrased
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return paraphrased
+
+
+    def paraphrase(self, messages: list) -> list:
+        orig = messages[-1]['content']  # only perturb the last message
         xx = []
 
-        for _p in paraphrased:
-            x = deepcopy(messages)
-            x[-1]['content'] = _p
-            xx.append(x)
+        for _p in self.paraphrases(orig):
+            xx.append(PerturbedMessages(messages, last_content=_p))
         return xx
         
-    def perturb(self, messages: list, temperature: float) -> list:
+    def perturb_with_diff(self, messages: list, temperature: float) -> list:
         paraphrased = self.paraphrase(messages)
         perturbed = []
         for _x in paraphrased:
-            perturbed.append((_x, temperature))
+            perturbed.append((_x, temperature, {'kind': 'last', 'content': _x[-1]['content']}))
         return perturbed
 
 
@@ -90,100 +219,114 @@ class Paraphrasing(Perturbation):
 class RandSysMsg(Perturbation):
     """
     The prompt is perturbed by inserting a random system message.
+
+    if `cache_friendly`, it is inserted before the last message instead of the first one,
+    so the variants share the conversation so far as their prompt prefix (see prompt_cache.py)
     """
-    def __init__(self, n: int) -> None:
-        self.sys_msg = [
-            'you are a helpful assistant',
-            'you are a question-answering assistant',
-            'you are a nice assistant',
-            'You are a helpful assistant',
-            'You are a question-answering assistant',
-            'You are a nice assistant',
-            'You are a helpful assistant.',
-            'You are a question-answering assistant.',
-            'You are a nice assistant.',
-        ]
+    sys_msg = [
+        'you are a helpful assistant',
+        'you are a question-answering assistant',
+        'you are a nice assistant',
+        'You are a helpful assistant',
+        'You are a question-answering assistant',
+        'You are a nice assistant',
+        'You are a helpful assistant.',
+        'You are a question-answering assistant.',
+        'You are a nice assistant.',
+    ]
+
+    def __init__(self, n: int, cache_friendly=False) -> None:
+        self.cache_friendly = cache_friendly
         self.n = n
         assert(n <= len(self.sys_msg))
 
 
-    def perturb(self, messages: list, temperature: float) -> list:
+    def perturb_with_diff(self, messages: list, temperature: float) -> list:
         sys_msgs = np.random.choice(self.sys_msg, self.n, replace=False)
         perturbed = []
         for sys_msg in sys_msgs:
-            x = [{'role': 'system', 'content': sys_msg}] + messages
-            perturbed.append((x, temperature))
+            x = PerturbedMessages(messages, system=str(sys_msg), system_tail=self.cache_friendly)
+            perturbed.append((x, temperature, {'kind': 'system', 'content': str(sys_msg), 'tail': self.cache_friendly}))
         return perturbed
     
 
 class DummyToken(Perturbation):
     """
     The prompt is perturbed by inserting a random dummy token.
+
+    if `cache_friendly`, the dummy tokens are all appended (none prepended) to the last message,
+    so the variants share the longest possible prompt prefix (see prompt_cache.py)
     """
 
-    def __init__(self, n: int) -> None:
+    dummy_tokens = [
+        {
+            'text': '\n',
+            'pos': 'both',
+        },
+        {
+            'text': '\t',
+            'pos': 'both',
+        },
+        {
+            'text': ' ',
+            'pos': 'both'
+        },
+        {
+            'text': '...',
+            'pos': 'both',
+        },
+        {
+            'text': ' um, ',
+            'pos': 'before'
+        },
+        {
+            'text': ' uh, ',
+            'pos': 'before'
+        },
+        {
+            'text': '?',
+            'pos': 'after'
+        },
+        {
+            'text': '??',
+            'pos': 'after'
+        },
+        {
+            'text': '\n\n',
+            'pos': 'both',
+        },
+        {
+            'text': ' um... ',
+            'pos': 'before'
+        },
+        {
+            'text': ' uh... ',
+            'pos': 'before'
+        },
+    ]
+
+    def __init__(self, n: int, cache_friendly=False) -> None:
         self.n = n
-        self.dummy_tokens = [
-            {
-                'text': '\n',
-                'pos': 'both',
-            },
-            {
-                'text': '\t',
-                'pos': 'both',
-            },
-            {
-                'text': ' ',
-                'pos': 'both'
-            },
-            {
-                'text': '...',
-                'pos': 'both',
-            },
-            {
-                'text': ' um, ',
-                'pos': 'before'
-            },
-            {
-                'text': ' uh, ',
-                'pos': 'before'
-            },
-            {
-                'text': '?',
-                'pos': 'after'
-            },
-            {
-                'text': '??',
-                'pos': 'after'
-            },
-            {
-                'text': '\n\n',
-                'pos': 'both',
-            },
-            {
-                'text': ' um... ',
-                'pos': 'before'
-            },
-            {
-                'text': ' uh... ',
-                'pos': 'before'
-            },
-        ]
-
-    def perturb(self, messages: list, temperature: float) -> list:
+        self.cache_friendly = cache_friendly
+        assert(n <= len(self.dummy_tokens))
+
+    def perturb_with_diff(self, messages: list, temperature: float) -> list:
         perturbed = []
         dummies = np.random.choice(self.dummy_tokens, self.n, replace=False)
         for dummy in dummies:
-            x = deepcopy(messages)
-            if dummy['pos'] == 'both':
+            diff = {'kind': 'affix', 'prefix': '', 'suffix': ''}
+            if self.cache_friendly:
+                diff['suffix'] = dummy['text']
+            elif dummy['pos'] == 'both':
                 if np.random.random() > 0.5:
-                    x[-1]['content'] = x[-1]['content'] + dummy['text']
+                    diff['suffix'] = dummy['text']
                 else:
-                    x[-1]['content'] = dummy['text'] + x[-1]['content']
+                    diff['prefix'] = dummy['text']
             elif dummy['pos'] == 'before':
-                x[-1]['content'] = dummy['text'] + x[-1]['content']
+                diff['prefix'] = dummy['text']
             else:
-                x[-1]['content'] = x[-1]['content'] + dummy['text']
-            perturbed.append((x, temperature))
+                diff['suffix'] = dummy['text']
+            x = PerturbedMessages(messages, last_content=diff['prefix'] + messages[-1]['content'] + diff['suffix'])
+            perturbed.append((x, temperature, diff))
         return perturbed
     
@@ -0,0 +1,97 @@
+"""
+estimate how many prompt tokens of the perturbed requests can be served from a prefix (prompt / KV) cache:
+a request can reuse the longest prefix it shares with any request sent before it.
+
+the tokens are counted with tiktoken if it is installed, or else approximated by splitting the words and symbols.
+it is an estimate: the providers also add a few tokens per message, and cache in blocks (e.g. of 128 tokens)
+above a minimum length.
+"""
+
+import re
+
+
+_MESSAGE_TOKENS = 4     # the tokens added per message by the chat format (role, separators)
+_WORDS = re.compile(r'\w+|[^\w\s]|\s+')
+_encoding = None
+
+
+def tokenize(text: str) -> list:
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except ImportError:
+            _encoding = False
+    if _encoding:
+        return _encoding.encode(text, disallowed_special=())
+    return _WORDS.findall(text)
+
+
+def _common_prefix(a: list, b: list) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class _Prompt:
+    """
+    the tokens of each message of a prompt, tokenized on demand
+    """
+
+    def __init__(self, messages, tokens: dict) -> None:
+        self.messages = messages    # not copied, the PerturbedMessages are indexed lazily
+        self._tokens = tokens   # shared between the prompts, keyed by (role, content)
+
+    def tokens(self, i) -> list:
+        key = (self.messages[i]['role'], self.messages[i]['content'])
+        if key not in self._tokens:
+            self._tokens[key] = tokenize(key[0]) + tokenize(key[1])
+        return self._tokens[key]
+
+    def __len__(self):
+        return sum(_MESSAGE_TOKENS + len(self.tokens(i)) for i in range(len(self.messages)))
+
+    def shared(self, other) -> int:
+        # the tokens of the identical leading messages, plus the common prefix of the first different one
+        n = 0
+        for i, (a, b) in enumerate(zip(self.messages, other.messages)):
+            if a is b or (a['role'], a['content']) == (b['role'], b['content']):
+                n += _MESSAGE_TOKENS + len(self.tokens(i))
+                continue
+            if a['role'] == b['role']:
+                n += _MESSAGE_TOKENS + _common_prefix(self.tokens(i), other.tokens(i))
+            break
+        return n
+
+
+def prompt_cache_stats(messages: list, perturbed: list) -> dict:
+    """
+    for the (messages, temperature) pairs in `perturbed`, sent in order (the pairs sharing the same messages
+    and temperature in a single request, as grouped by `LLM.generate_many`):
+    * `total`: the prompt tokens sent
+    * `cached`: those shared with a previous request, which a prefix cache can serve
+    * `uncached`: the others, to prefill
+    * `shared_prefix`: the tokens shared by all the requests and the original `messages`
+    """
+    tokens = {}
+    original = _Prompt(messages, tokens)
+    prompts = []
+    seen = set()
+    for x, t in perturbed:
+        if (id(x), t) not in seen:
+            # the same messages at another temperature are another request, with the whole prompt cached
+            seen.add((id(x), t))
+            prompts.append(_Prompt(x, tokens))
+
+    total = cached = 0
+    shared_prefix = len(original)
+    for i, prompt in enumerate(prompts):
+        n = len(prompt)
+        total += n
+        cached += max([min(prompt.shared(prev), n) for prev in prompts[:i]], default=0)
+        shared_prefix = min(shared_prefix, prompt.shared(original))
+    return {'total': total, 'cached': cached, 'uncached': total - cached, 'shared_prefix': shared_prefix}
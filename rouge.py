@@ -0,0 +1,139 @@
+"""
+a ROUGE engine returning exactly the same scores as `rouge_score.RougeScorer(..., use_stemmer=True)`, but faster:
+* each text is tokenized and stemmed only once (the tokens are cached), and each word is stemmed only once
+* the LCS (for rougeL) is computed bit-parallel, one reference against many candidates
+"""
+
+import threading
+from collections import Counter, OrderedDict
+import numpy as np
+
+
+class _CachedStemmer:
+    """
+    the Porter stemmer used by rouge_score, memoized per word
+    """
+
+    def __init__(self, max_size=100000) -> None:
+        from nltk.stem import porter
+        self.stemmer = porter.PorterStemmer()
+        self.max_size = max_size
+        self.stems = {}
+
+    def stem(self, word):
+        stem = self.stems.get(word)
+        if stem is None:
+            if len(self.stems) >= self.max_size:
+                self.stems.clear()
+            stem = self.stems[word] = self.stemmer.stem(word)
+        return stem
+
+
+class Tokens:
+    """
+    the (stemmed) tokens of a text, with the n-gram counts and LCS match masks computed on demand
+    """
+
+    def __init__(self, words: tuple) -> None:
+        self.words = words
+        self._ngrams = {}
+        self._masks = None
+
+    def __len__(self):
+        return len(self.words)
+
+    def ngrams(self, n: int) -> Counter:
+        if n not in self._ngrams:
+            words = self.words
+            self._ngrams[n] = Counter(tuple(words[i: i + n]) for i in range(len(words) - n + 1))
+        return self._ngrams[n]
+
+    def masks(self) -> dict:
+        # bit i of masks[token] is set if words[i] == token
+        if self._masks is None:
+            masks = {}
+            for i, token in enumerate(self.words):
+                masks[token] = masks.get(token, 0) | (1 << i)
+            self._masks = masks
+        return self._masks
+
+
+def lcs_length(a: Tokens, b: Tokens) -> int:
+    """
+    the length of the longest common subsequence, bit-parallel (Hyyro, 2004),
+    in O(len(a) * len(b) / word size) instead of the O(len(a) * len(b)) dynamic programming
+    """
+    m = len(a)
+    full = (1 << m) - 1
+    masks = a.masks()
+    v = full
+    for token in b.words:
+        u = v & masks.get(token, 0)
+        v = ((v + u) | (v - u)) & full
+    return m - v.bit_count()
+
+
+def fmeasure(precision, recall):
+    # same as rouge_score.scoring.fmeasure
+    if precision + recall > 0:
+        return 2 * precision * recall / (precision + recall)
+    else:
+        return 0.0
+
+
+class RougeEngine:
+    """
+    `score(target, prediction, method)` matches `RougeScorer.score(target, prediction)[method].fmeasure`
+    for method in rouge1, rouge2 (or any rougeN) and rougeL
+    """
+
+    def __init__(self, max_size=10000) -> None:
+        from rouge_score import tokenize
+        self._tokenize = tokenize.tokenize
+        self.stemmer = _CachedStemmer()
+        self.max_size = max_size
+        self.cache = OrderedDict()   # text -> Tokens
+        self.lock = threading.Lock()
+
+
+    def tokens(self, text: str) -> Tokens:
+        with self.lock:
+            tokens = self.cache.get(text)
+            if tokens is not None:
+                self.cache.move_to_end(text)
+                return tokens
+        # the tokens are kept as strings, not as ids in a vocabulary that would grow without bound
+        tokens = Tokens(tuple(self._tokenize(text, self.stemmer)))
+        with self.lock:
+            self.cache[text] = tokens
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+            return tokens
+
+
+    def _score(self, target: Tokens, prediction: Tokens, method: str) -> float:
+        if method == 'rougeL':
+            if not len(target) or not len(prediction):
+                return 0.
+            lcs = lcs_length(target, prediction)
+            return fmeasure(lcs / len(prediction), lcs / len(target))
+
+        n = int(method[5:])
+        target_ngrams = target.ngrams(n)
+        prediction_ngrams = prediction.ngrams(n)
+        overlap = sum((target_ngrams & prediction_ngrams).values())
+        precision = overlap / max(sum(prediction_ngrams.values()), 1)
+        recall = overlap / max(sum(target_ngrams.values()), 1)
+        return fmeasure(precision, recall)
+
+
+    def score(self, target: str, prediction: str, method: str) -> float:
+        return self._score(self.tokens(target), self.tokens(prediction), method)
+
+
+    def score_batch(self, target: str, predictions: list, method: str) -> np.ndarray:
+        """
+        score the `target` against each of the `predictions`, the target is tokenized (and its LCS masks built) once
+        """
+        target = self.tokens(target)
+        return np.array([self._score(target, self.tokens(p), method) for p in predictions])
@@ -0,0 +1,172 @@
+"""
+score the text similarity in a pool of worker processes, so the CPU-bound aggregation
+(ROUGE stemming, sbert / bertscore forward passes) is not serialized by the GIL of the calling process.
+
+each worker loads its models once (and keeps its own caches), the texts are sent to the workers and the scores
+sent back through shared memory blocks instead of pickled copies, and the jobs of all the threads
+(e.g. concurrent SPUQ.run calls) and coroutines (see `ascore_batch`) share the same pool.
+"""
+
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from text_sim import TextSimilarity, SBERT_MODEL
+import tracing
+
+
+_worker_text_sim = None
+
+
+def _init_worker(sbert_model, sbert_backend, bertscore_model, bertscore_threads, preload):
+    global _worker_text_sim
+    _worker_text_sim = TextSimilarity(sbert_model=sbert_model, sbert_backend=sbert_backend,
+                                      bertscore_model=bertscore_model, bertscore_threads=bertscore_threads)
+    for method in preload:
+        _worker_text_sim._score_batch('warm up', ['warm up'], method)   # load the model now, not on the first job
+
+
+def _read_texts(name, offsets):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        data = bytes(shm.buf[:offsets[-1]])
+    finally:
+        shm.close()
+    return [data[offsets[i]: offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def _write_scores(name, scores):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        np.ndarray(scores.shape, dtype=np.float64, buffer=shm.buf)[...] = scores
+    finally:
+        shm.close()
+
+
+def _worker_score_batch(texts_name, offsets, out_name, method):
+    a, *bb = _read_texts(texts_name, offsets)
+    _write_scores(out_name, np.asarray(_worker_text_sim._score_batch(a, bb, method), dtype=np.float64))
+
+
+def _worker_similarity_matrix(texts_name, offsets, out_name, method):
+    texts = _read_texts(texts_name, offsets)
+    _write_scores(out_name, np.asarray(_worker_text_sim.similarity_matrix(texts, method), dtype=np.float64))
+
+
+class _Job:
+    """
+    the shared memory blocks of one job: the texts (UTF-8, concatenated) in, the scores out
+    """
+
+    def __init__(self, texts: list, shape: tuple) -> None:
+        encoded = [t.encode('utf-8') for t in texts]
+        self.offsets = [0]
+        for e in encoded:
+            self.offsets.append(self.offsets[-1] + len(e))
+        self.shape = shape
+        self.texts = shared_memory.SharedMemory(create=True, size=max(self.offsets[-1], 1))
+        self.texts.buf[:self.offsets[-1]] = b''.join(encoded)
+        self.out = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * 8, 1))
+
+    def result(self) -> np.ndarray:
+        try:
+            return np.ndarray(self.shape, dtype=np.float64, buffer=self.out.buf).copy()
+        finally:
+            self.close()
+
+    def close(self):
+        for shm in [self.texts, self.out]:
+            shm.close()
+            shm.unlink()
+
+
+class ScoringPool(TextSimilarity):
+    """
+    a drop-in `TextSimilarity` (e.g. `SPUQ(..., text_sim=ScoringPool(4))`) scoring in `max_workers` processes.
+    the batches and similarity matrices are scored by the workers, and so are the single pairs with sbert / bertscore;
+    the single ROUGE pairs (e.g. the input weights) are cheaper to score here than to send to a worker.
+    `preload` lists the methods whose models are loaded when each worker starts.
+    """
+
+    def __init__(self, max_workers=None, sbert_model=SBERT_MODEL, sbert_backend='torch', preload=(),
+                 mp_context='spawn', bertscore_model=None, bertscore_threads=None) -> None:
+        super().__init__(sbert_model=sbert_model, sbert_backend=sbert_backend, bertscore_model=bertscore_model,
+                         bertscore_threads=bertscore_threads)
+        # spawn, since forking a process with the torch threads already started can deadlock
+        self.pool = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context(mp_context),
+            initializer=_init_worker,
+            initargs=(sbert_model, sbert_backend, bertscore_model, bertscore_threads, tuple(preload)),
+        )
+
+
+    def _submit(self, fn, texts, shape, method):
+        job = _Job(texts, shape)
+        try:
+            fut = self.pool.submit(fn, job.texts.name, job.offsets, job.out.name, method)
+        except BaseException:
+            job.close()
+            raise
+        return job, fut
+
+
+    def _run(self, fn, texts, shape, method) -> np.ndarray:
+        job, fut = self._submit(fn, texts, shape, method)
+        with tracing.span('scoring_pool.wait', method=method):
+            try:
+                fut.result()
+            except BaseException:
+                job.close()
+                raise
+        return job.result()
+
+
+    async def _arun(self, fn, texts, shape, method) -> np.ndarray:
+        job, fut = self._submit(fn, texts, shape, method)
+        try:
+            await asyncio.wrap_future(fut)
+        except BaseException:
+            job.close()
+            raise
+        return job.result()
+
+
+    def _score(self, a: str, b: str, method: str) -> float:
+        if method in ['rouge1', 'rouge2', 'rougeL']:
+            return super()._score(a, b, method)
+        return self._score_batch(a, [b], method)[0]
+
+
+    def _score_batch(self, a: str, bb: list, method: str) -> np.ndarray:
+        if not bb:
+            return np.zeros(0)
+        return self._run(_worker_score_batch, [a] + list(bb), (len(bb),), method)
+
+
+    def similarity_matrix(self, texts: list, method: str) -> np.ndarray:
+        return self._run(_worker_similarity_matrix, list(texts), (len(texts), len(texts)), method)
+
+
+    async def ascore_batch(self, a: str, bb: list, method: str) -> np.ndarray:
+        """
+        the asyncio versions of `score_batch` and `similarity_matrix`, the event loop is free while the workers score
+        """
+        if not bb:
+            return np.zeros(0)
+        return await self._arun(_worker_score_batch, [a] + list(bb), (len(bb),), method)
+
+
+    async def asimilarity_matrix(self, texts: list, method: str) -> np.ndarray:
+        return await self._arun(_worker_similarity_matrix, list(texts), (len(texts), len(texts)), method)
+
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,272 @@
+"""
+a long-running local HTTP service wrapping SPUQ, on asyncio (standard library only),
+so several services share the resident models (TextSimilarity) and the LLM clients.
+
+POST /score   {"messages": [...]} or {"prompt": "..."}, and optionally
+              "temperature" (0.7), "perturbation" ("paraphrasing"), "aggregation" ("rougeL"),
+              "n_perturb" (5, at most `max_n_perturb`)
+              -> {"confidence": ..., "outputs": [...], "perturbed": [[messages, temperature], ...]}
+GET /health   -> {"status": "ok", "in_flight": ..., "queued": ...}
+GET /metrics  -> the Prometheus text format, see tracing.CounterRegistry
+
+the concurrent identical requests are coalesced onto a single computation.
+at most `max_in_flight` computations run at a time, and up to `max_queued` more wait for their turn;
+beyond that, the requests are rejected with 503, so the clients back off instead of piling up.
+
+python server.py --port 8080 --model gpt-3.5-turbo-0301 --max-in-flight 16 --max-queued 256
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+from collections import OrderedDict
+from llms import LLM
+from perturbation import RandSysMsg, DummyToken
+from spuq import SPUQ, PERTURBATIONS, AGGREGATIONS
+from text_sim import TextSimilarity
+from tracing import CounterRegistry
+import tracing
+
+
+class Overloaded(Exception):
+    pass
+
+
+class BadRequest(Exception):
+    pass
+
+
+class SPUQService:
+    """
+    the SPUQ instances are built once per (perturbation, aggregation, n_perturb), and share `llm` and `text_sim`;
+    the `max_spuqs` most recently used are kept
+    """
+
+    def __init__(self, llm: LLM, paraphrase_llm: LLM = None, text_sim: TextSimilarity = None,
+                 max_in_flight=8, max_queued=64, max_workers=4, registry: CounterRegistry = None,
+                 temperature_buckets=None, max_n_perturb=20, max_spuqs=32, prompt_stats=False) -> None:
+        self.llm = llm
+        self.paraphrase_llm = paraphrase_llm
+        self.text_sim = text_sim if text_sim is not None else TextSimilarity()
+        self.max_workers = max_workers
+        self.temperature_buckets = temperature_buckets
+        self.prompt_stats = prompt_stats
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.max_n_perturb = max_n_perturb
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.max_spuqs = max_spuqs
+        self.spuqs = OrderedDict()
+        self.pending = {}   # request key -> future of its report, for the computations admitted and not done
+        self.in_flight = 0  # the computations running, the others pending are queued
+        self.registry = registry if registry is not None else CounterRegistry()
+
+
+    def spuq(self, perturbation: str, aggregation: str, n_perturb: int) -> SPUQ:
+        config = (perturbation, aggregation, n_perturb)
+        if config in self.spuqs:
+            self.spuqs.move_to_end(config)
+        else:
+            self.spuqs[config] = SPUQ(llm=self.llm, perturbation=perturbation, aggregation=aggregation,
+                                      n_perturb=n_perturb, max_workers=self.max_workers, text_sim=self.text_sim,
+                                      paraphrase_llm=self.paraphrase_llm, temperature_buckets=self.temperature_buckets,
+                                      prompt_stats=self.prompt_stats)
+            while len(self.spuqs) > self.max_spuqs:
+                self.spuqs.popitem(last=False)
+        return self.spuqs[config]
+
+
+    def parse(self, request: dict) -> tuple:
+        if 'messages' in request:
+            messages = request['messages']
+        elif 'prompt' in request:
+            messages = [{'role': 'user', 'content': request['prompt']}]
+        else:
+            raise ValueError('either "messages" or "prompt" is required')
+        if not isinstance(messages, list) or not messages or \
+                not all(isinstance(m, dict) and isinstance(m.get('content'), str) for m in messages):
+            raise ValueError('"messages" must be a non-empty list of {"role", "content"}')
+        temperature = float(request.get('temperature', 0.7))
+        config = (request.get('perturbation', 'paraphrasing'), request.get('aggregation', 'rougeL'),
+                  int(request.get('n_perturb', 5)))
+        perturbation, aggregation, n_perturb = config
+        if perturbation not in PERTURBATIONS:
+            raise ValueError('"perturbation" must be one of %s'%', '.join(PERTURBATIONS))
+        if aggregation not in AGGREGATIONS:
+            raise ValueError('"aggregation" must be one of %s'%', '.join(AGGREGATIONS))
+        if not 0 < n_perturb <= self.max_n_perturb:
+            raise ValueError('"n_perturb" must be between 1 and %i'%self.max_n_perturb)
+        for name, choices in [('system_message', RandSysMsg.sys_msg), ('dummy_token', DummyToken.dummy_tokens)]:
+            if perturbation == name and n_perturb > len(choices):
+                raise ValueError('"n_perturb" must be at most %i with %s'%(len(choices), name))
+        return messages, temperature, config
+
+
+    async def score(self, request: dict) -> dict:
+        """
+        the SPUQ report of `request`, shared by all the identical requests in progress.
+        raises BadRequest for an invalid request, and Overloaded when the queue is full
+        """
+        self.registry.count('server.request', 1, {})
+        try:
+            messages, temperature, config = self.parse(request)
+        except (ValueError, TypeError) as e:
+            raise BadRequest(str(e)) from e
+        spuq = self.spuq(*config)
+        key = hashlib.sha256(json.dumps([messages, temperature, config], sort_keys=True).encode('utf-8')).hexdigest()
+
+        fut = self.pending.get(key)
+        if fut is not None:
+            self.registry.count('server.coalesced', 1, {})
+        else:
+            if len(self.pending) >= self.max_in_flight + self.max_queued:
+                self.registry.count('server.rejected', 1, {})
+                raise Overloaded('%i requests queued'%self.queued)
+            fut = asyncio.ensure_future(self._run(spuq, messages, temperature))
+            self.pending[key] = fut
+            fut.add_done_callback(lambda _: self.pending.pop(key, None))
+        # shielded, so a client going away does not cancel the computation shared with the others
+        return await asyncio.shield(fut)
+
+
+    @property
+    def queued(self) -> int:
+        return len(self.pending) - self.in_flight
+
+
+    async def _run(self, spuq: SPUQ, messages: list, temperature: float) -> dict:
+        await self.slots.acquire()
+        self.in_flight += 1
+        try:
+            with tracing.collect(self.registry):
+                report = await spuq.arun(messages, temperature)
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+        out = {
+            'confidence': report['confidence'],
+            'outputs': report['outputs'],
+            'perturbed': [[list(x), t] for x, t in report['perturbed']],
+        }
+        if 'prompt_tokens' in report:
+            out['prompt_tokens'] = report['prompt_tokens']
+        return out
+
+
+    def health(self) -> dict:
+        return {'status': 'ok', 'in_flight': self.in_flight, 'queued': self.queued}
+
+
+    def metrics(self) -> str:
+        gauges = '%s_server_in_flight %i\n%s_server_queued %i\n'%(
+            self.registry.prefix, self.in_flight, self.registry.prefix, self.queued)
+        return self.registry.render() + gauges
+
+
+    async def handle(self, method: str, path: str, body: bytes) -> tuple:
+        """
+        returns (status, content type, body)
+        """
+        if method == 'GET' and path == '/health':
+            return 200, 'application/json', json.dumps(self.health())
+        if method == 'GET' and path == '/metrics':
+            return 200, 'text/plain; version=0.0.4', self.metrics()
+        if method == 'POST' and path == '/score':
+            try:
+                try:
+                    request = json.loads(body)
+                except ValueError as e:
+                    raise BadRequest(str(e)) from e
+                if not isinstance(request, dict):
+                    raise BadRequest('the request must be a JSON object')
+                report = await self.score(request)
+            except BadRequest as e:
+                return 400, 'application/json', json.dumps({'error': str(e)})
+            except Overloaded as e:
+                return 503, 'application/json', json.dumps({'error': 'overloaded: %s'%e})
+            except Exception as e:
+                return 500, 'application/json', json.dumps({'error': '%s: %s'%(type(e).__name__, e)})
+            return 200, 'application/json', json.dumps(report)
+        return 404, 'application/json', json.dumps({'error': 'not found'})
+
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # a minimal HTTP/1.1 server: one request at a time per connection, kept alive unless asked otherwise
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path, _ = line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    k, v = line.decode('latin-1').split(':', 1)
+                    headers[k.strip().lower()] = v.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, content_type, content = await self.handle(method, path.split('?')[0], body)
+                content = content.encode('utf-8')
+                close = headers.get('connection', '').lower() == 'close'
+                head = ['HTTP/1.1 %i %s'%(status, _REASONS[status]), 'Content-Type: ' + content_type,
+                        'Content-Length: %i'%len(content)]
+                if status == 503:
+                    head.append('Retry-After: 1')
+                if close:
+                    head.append('Connection: close')
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + content)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def start(self, host='127.0.0.1', port=8080) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self._serve, host, port)
+
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def main():
+    from batch import make_llms
+    parser = argparse.ArgumentParser(description='serve SPUQ over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--model', default='gpt-3.5-turbo-0301')
+    parser.add_argument('--paraphrase-model', help='default: MODEL')
+    parser.add_argument('--backend', default='openai', choices=['openai', 'local', 'fake'])
+    parser.add_argument('--base-url')
+    parser.add_argument('--max-retries', type=int, default=2)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--cache', help='SQLite file to cache the LLM responses')
+    parser.add_argument('--max-concurrency', type=int, help='LLM requests in flight in total')
+    parser.add_argument('--max-workers', type=int, default=4, help='LLM requests in flight per computation')
+    parser.add_argument('--max-in-flight', type=int, default=8, help='computations running at a time')
+    parser.add_argument('--max-queued', type=int, default=64, help='computations waiting, beyond that 503')
+    parser.add_argument('--temperature-buckets', type=int,
+                        help='snap the perturbed temperatures to N buckets, so the equal ones share a request')
+    parser.add_argument('--max-n-perturb', type=int, default=20, help='the largest n_perturb of a request')
+    parser.add_argument('--prompt-stats', action='store_true', help='estimate the prompt tokens of each request')
+    args = parser.parse_args()
+
+    async def serve():
+        llm, paraphrase_llm = make_llms(args)
+        service = SPUQService(llm, paraphrase_llm, max_in_flight=args.max_in_flight, max_queued=args.max_queued,
+                              max_workers=args.max_workers, temperature_buckets=args.temperature_buckets,
+                              max_n_perturb=args.max_n_perturb, prompt_stats=args.prompt_stats)
+        server = await service.start(args.host, args.port)
+        print('serving on http://%s:%i'%(args.host, args.port))
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,43 +1,168 @@
 from perturbation import Paraphrasing, RandSysMsg, DummyToken, TemperaturePerturbation
-from aggregation import IntraSampleAggregation, InterSampleAggregation
+from aggregation import IntraSampleAggregation, InterSampleAggregation, RunningConfidence
 from llms import LLM
+from text_sim import TextSimilarity
+from tracing import TimingCollector
+from prompt_cache import prompt_cache_stats
+import tracing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import asyncio
+from collections import Counter
+
+
+PERTURBATIONS = ['paraphrasing', 'system_message', 'dummy_token', 'temperature']
+AGGREGATIONS = ['rouge1', 'rouge2', 'rougeL', 'sbert', 'bertscore', 'verbalized_word', 'verbalized_num']
+
 
 class SPUQ:
-    def __init__(self, llm: LLM, perturbation: str, aggregation: str, n_perturb: int):
+    def __init__(self, llm: LLM, perturbation: str, aggregation: str, n_perturb: int, max_workers=1,
+                 text_sim: TextSimilarity = None, paraphrase_llm: LLM = None, pairs='anchor', consistency='mean',
+                 cache_friendly=False, temperature_buckets=None, prompt_stats=False):
         self.llm = llm
+        self.prompt_stats = prompt_stats    # estimate the prompt tokens of each run, see `prompt_tokens`
         assert(n_perturb > 0)
+        assert(max_workers > 0)
+        self.max_workers = max_workers  # max number of LLM requests in flight
 
         if perturbation == 'paraphrasing':
-            self.perturbation = Paraphrasing(n_perturb)
+            self.perturbation = Paraphrasing(n_perturb, llm=paraphrase_llm)
         elif perturbation == 'system_message':
-            self.perturbation = RandSysMsg(n_perturb)
+            self.perturbation = RandSysMsg(n_perturb, cache_friendly=cache_friendly)
         elif perturbation == 'dummy_token':
-            self.perturbation = DummyToken(n_perturb)
+            self.perturbation = DummyToken(n_perturb, cache_friendly=cache_friendly)
         elif perturbation == 'temperature':
-            self.perturbation = TemperaturePerturbation(llm.T_min, llm.T_max, n_perturb)
+            self.perturbation = TemperaturePerturbation(n_perturb, n_buckets=temperature_buckets)
         else:
             raise ValueError('Invalid perturbation method: %s'%perturbation)
         
         if aggregation in ['rouge1', 'rouge2', 'rougeL', 'sbert', 'bertscore']:
-            self.aggregation = InterSampleAggregation(aggregation)
+            self.aggregation = InterSampleAggregation(aggregation, text_sim=text_sim, pairs=pairs, consistency=consistency)
         elif aggregation in ['verbalized_word', 'verbalized_num']:
-            self.aggregation = IntraSampleAggregation(llm, kind=aggregation)
+            self.aggregation = IntraSampleAggregation(llm, kind=aggregation, text_sim=text_sim, max_workers=max_workers)
         else:
             raise ValueError('Invalid aggregation method: %s'%aggregation)
 
     
-    def run(self, messages: list, temperature: float):
-        perturbed = self.perturbation.perturb(messages, temperature)
+    def run(self, messages: list, temperature: float, threshold=None, z=2., min_samples=2, timing=False):
+        """
+        if `threshold` is given, the outputs are generated (in waves of `max_workers`) and aggregated incrementally,
+        and no more perturbed variants are generated once the confidence is clearly above or below the threshold,
+        i.e. more than `z` standard errors away from it, after at least `min_samples` samples.
+        the early exit follows the running mean similarity, so it requires the `mean` consistency.
+
+        if `timing`, the report includes the time spent per stage, and the counters (tokens, cache hits, etc.),
+        see `tracing` to send them to other sinks.
+        """
+        if timing:
+            with tracing.collect(TimingCollector()) as collector:
+                report = self.run(messages, temperature, threshold, z, min_samples)
+            report['timing'] = collector.summary()
+            return report
+
+        if threshold is not None and getattr(self.aggregation, 'consistency', 'mean') != 'mean':
+            raise ValueError('early exit (threshold) requires consistency="mean", not %s'%self.aggregation.consistency)
+        with tracing.span('spuq.run'):
+            if threshold is not None:
+                return self.run_early_exit(messages, temperature, threshold, z, min_samples)
+
+            perturbed, diffs = self.perturb(messages, temperature)
+            outs = self.llm.generate_many(perturbed, max_workers=self.max_workers)
+            inp_out = [(x, out) for (x, _), out in zip(perturbed, outs)]
+            with tracing.span('aggregate'):
+                conf = self.aggregation.aggregate(inp_out, diffs=diffs)
+            return self.report(messages, perturbed, outs, conf)
+
+
+    async def arun(self, messages: list, temperature: float):
+        """
+        the asyncio version of `run` (without early exit): the outputs are generated on the event loop,
+        while the perturbation (which may call the paraphraser) and the aggregation run in a thread,
+        e.g. waiting for a `scoring_pool.ScoringPool`
+        """
+        with tracing.span('spuq.run'):
+            perturbed, diffs = await asyncio.to_thread(self.perturb, messages, temperature)
+            outs = await self.llm.agenerate_many(perturbed, max_workers=self.max_workers)
+            inp_out = [(x, out) for (x, _), out in zip(perturbed, outs)]
+            with tracing.span('aggregate'):
+                conf = await asyncio.to_thread(self.aggregation.aggregate, inp_out, diffs)
+            return self.report(messages, perturbed, outs, conf)
+
+
+    def report(self, messages: list, perturbed: list, outs: list, conf: float, **kwargs) -> dict:
+        report = {'perturbed': perturbed, 'outputs': outs, 'confidence': conf, **kwargs}
+        if self.prompt_stats:
+            report['prompt_tokens'] = self.prompt_tokens(messages, perturbed)
+        return report
+
+
+    def prompt_tokens(self, messages: list, perturbed: list) -> dict:
+        """
+        the estimated prompt tokens of the perturbed requests, and how many of them a prefix cache can serve,
+        see `prompt_cache.prompt_cache_stats`
+        """
+        with tracing.span('prompt_cache'):
+            stats = prompt_cache_stats(messages, perturbed)
+        tracing.count('prompt.tokens_estimate', stats['total'])
+        tracing.count('prompt.cached_tokens_estimate', stats['cached'])
+        return stats
+
+
+    def perturb(self, messages: list, temperature: float):
+        """
+        returns the perturbed (messages, temperature) pairs, and how each of them differs from `messages`
+        """
+        with tracing.span('perturb', method=type(self.perturbation).__name__):
+            perturbed = self.perturbation.perturb_with_diff(messages, temperature)
+        return [(x, t) for x, t, _ in perturbed], [diff for _, _, diff in perturbed]
+
+
+    def run_early_exit(self, messages: list, temperature: float, threshold: float, z=2., min_samples=2):
+        perturbed, diffs = self.perturb(messages, temperature)
+        estimate = RunningConfidence()
         inp_out = []
         outs = []
-        for x, temperature in perturbed:
-            out = self.llm.generate(x, temperature=temperature)
-            outs.append(out)
-            inp_out.append((x, out))
-        conf = self.aggregation.aggregate(inp_out)
-        return {
-            'perturbed': perturbed,
-            'outputs': outs,
-            'confidence': conf,
-        }
-    
\ No newline at end of file
+        seen = Counter()
+        for start in range(0, len(perturbed), self.max_workers):
+            wave = perturbed[start: start + self.max_workers]
+            for (x, _), out in zip(wave, self.llm.generate_many(wave, max_workers=self.max_workers, seen=seen)):
+                outs.append(out)
+                inp_out.append((x, out))
+                with tracing.span('aggregate'):
+                    self.aggregation.update(estimate, inp_out, len(inp_out) - 1, diffs=diffs)
+            if estimate.n >= min_samples and abs(estimate.mean - threshold) > z * estimate.stderr:
+                break
+        return self.report(messages, perturbed[:len(outs)], outs, estimate.mean, stderr=estimate.stderr)
+
+
+    def run_many(self, messages_list, temperature: float, max_queries=8, **kwargs):
+        """
+        run SPUQ over many queries, with up to `max_queries` of them in progress at a time.
+        `messages_list` can be any iterable (e.g. a generator) and is consumed lazily.
+        `kwargs` are passed to `run` (e.g. `threshold`).
+        yields (index, report) as soon as each query finishes, so not in the input order.
+        a failed query yields (index, {'error': ...}) and does not affect the others.
+
+        to bound the LLM requests in flight across all queries, use `LLM(max_concurrency=...)`
+        """
+        assert(max_queries > 0)
+        queries = enumerate(messages_list)
+        with ThreadPoolExecutor(max_workers=max_queries) as pool:
+            pending = {}
+
+            def submit():
+                for i, messages in queries:
+                    pending[pool.submit(tracing.bind(self.run), messages, temperature, **kwargs)] = i
+                    return
+
+            for _ in range(max_queries):
+                submit()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    i = pending.pop(fut)
+                    try:
+                        report = fut.result()
+                    except Exception as e:
+                        report = {'error': '%s: %s'%(type(e).__name__, e)}
+                    submit()
+                    yield i, report
@@ -1,7 +1,9 @@
 import os, sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from aggregation import InterSampleAggregation, IntraSampleAggregation
-from llms import LLM
+from aggregation import InterSampleAggregation, IntraSampleAggregation, RunningConfidence
+from perturbation import DummyToken, RandSysMsg, TemperaturePerturbation
+from llms import LLM, FakeBackend
+import numpy as np
 import unittest
 
 
@@ -36,7 +38,7 @@ class TestAggregation(unittest.TestCase):
         self.llm = LLM()
 
     def test_intra(self):
-        agg = IntraSampleAggregation(self.llm, kind='num')
+        agg = IntraSampleAggregation(self.llm, kind='verbalized_num')
         confidence_a = agg.aggregate(self.a)
         confidence_b = agg.aggregate(self.b)
         print('Intra-sample: confidence_a %.3f confidence_b %.3f'%(confidence_a, confidence_b))
@@ -50,5 +52,95 @@ class TestAggregation(unittest.TestCase):
         self.assertTrue(confidence_a >= confidence_b)
 
 
+class TestVerbalized(unittest.TestCase):
+
+    def test_extract(self):
+        agg = IntraSampleAggregation(LLM(backend=FakeBackend()), kind='verbalized_num')
+        for verbalized, conf in [
+            ('0.8', 0.8), ('My confidence is 0.95.', 0.95), ('I am 85% sure', 0.85), ('about 7/10', 0.7),
+            ('Confidence: 1', 1.), ('Out of 3 options, 0.6', 0.6), ('no idea', 0.5), ('', 0.5),
+        ]:
+            self.assertAlmostEqual(agg.extract(verbalized), conf)
+
+        agg = IntraSampleAggregation(LLM(backend=FakeBackend()), kind='verbalized_word')
+        for verbalized, conf in [('High', 0.75), ('my confidence is low.', 0.25), ('Medium', 0.5), ('highly', 0.5)]:
+            self.assertAlmostEqual(agg.extract(verbalized), conf)
+
+    def test_batch(self):
+        backend = FakeBackend(responses=['0.9', 'High confidence: 80%', 'not sure'])
+        agg = IntraSampleAggregation(LLM(backend=backend), kind='verbalized_num', max_workers=3)
+        inp = [{'role': 'user', 'content': 'Is 100 greater than 3?'}]
+        inp_out = [(inp, 'Yes.'), (inp, 'Yes, it is.'), (inp, 'Yes.')]
+        confs = agg.confidences(inp_out)
+        # the same as one by one, with the duplicate pair asked once
+        self.assertEqual(confs, [agg.single_confidence(inp, out) for inp, out in inp_out])
+        self.assertEqual(backend.n_requests, 2 + 3)
+
+
+class TestConsistency(unittest.TestCase):
+
+    def test(self):
+        inp = [{'role': 'user', 'content': 'Is 100 greater than 3?'}]
+        outs = ['Yes it is.', 'No, 3 is greater.', 'Yes, it is.', 'Well it depends.']
+        inp_out = [(inp, out) for out in outs]
+        for consistency in ['mean', 'spectral', 'cluster']:
+            agg = InterSampleAggregation('rougeL', pairs='all', consistency=consistency)
+            conf = agg.aggregate(inp_out)
+            # does not depend on which output comes first
+            self.assertAlmostEqual(conf, agg.aggregate(inp_out[::-1]))
+            self.assertTrue(0 <= conf <= 1)
+            self.assertAlmostEqual(agg.aggregate([(inp, 'Yes.')] * 3), 1.)
+
+        sim = np.array([[1., .9, 0.], [.9, 1., 0.], [0., 0., 1.]])
+        scores = InterSampleAggregation('rougeL').consistency_scores(sim, np.ones(3))
+        self.assertAlmostEqual(scores['mean'], .3)
+        self.assertAlmostEqual(scores['spectral'], 1.9 / 3)
+        self.assertAlmostEqual(scores['cluster'], 2 / 3)
+
+        # sampling all the pairs is the all-pairs mean
+        agg = InterSampleAggregation('rougeL', pairs='sampled', n_pairs=6)
+        self.assertAlmostEqual(agg.aggregate(inp_out), InterSampleAggregation('rougeL', pairs='all').aggregate(inp_out))
+
+        # the same outputs get the same sampled pairs, call after call
+        agg = InterSampleAggregation('rougeL', pairs='sampled', n_pairs=2)
+        self.assertEqual(len(set(agg.aggregate(inp_out) for _ in range(10))), 1)
+
+
+class TestRunningConfidence(unittest.TestCase):
+
+    def test(self):
+        estimate = RunningConfidence()
+        confs = [0.9, 0.8, 0.85, 0.95]
+        wts = [1., 0.5, 1., 0.8]
+        for conf, wt in zip(confs, wts):
+            estimate.add(conf, wt)
+        self.assertAlmostEqual(estimate.mean, sum(c * w for c, w in zip(confs, wts)) / sum(wts))
+        self.assertTrue(0 < estimate.stderr < 0.1)
+
+        estimate = RunningConfidence()
+        estimate.add(0.5, 1.)
+        self.assertTrue(estimate.stderr == float('inf'))   # not enough samples to tell
+
+
+class TestDiffWeights(unittest.TestCase):
+
+    def test(self):
+        """
+        the weights from the diff descriptors are the same as re-scoring the whole conversation
+        """
+        np.random.seed(2024)
+        agg = InterSampleAggregation(metric='rougeL')
+        messages = [
+            {'role': 'user', 'content': 'Is 100 greater than 3?'},
+            {'role': 'assistant', 'content': 'Yes, 100 is greater than 3.'},
+            {'role': 'user', 'content': 'Are you sure?'},
+        ]
+        for perturbation in [DummyToken(n=5), RandSysMsg(n=5), TemperaturePerturbation(n=3)]:
+            perturbed = perturbation.perturb_with_diff(messages, 0.7)
+            inp0, _, diff0 = perturbed[0]
+            for inp, _, diff in perturbed:
+                self.assertEqual(agg.calc_wt(inp0, inp, diff0, diff), agg.calc_wt(inp0, inp))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
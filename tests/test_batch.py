@@ -0,0 +1,76 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import batch
+import gzip
+import json
+import tempfile
+from argparse import Namespace
+import unittest
+
+
+class TestBatch(unittest.TestCase):
+
+    def write_queries(self, path, n):
+        with open(path, 'w') as f:
+            for i in range(n):
+                f.write(json.dumps({'id': 'q%i'%i, 'prompt': 'Is %i greater than 3?'%i}) + '\n')
+
+    def read_reports(self, path):
+        with gzip.open(path, 'rt') as f:
+            return [json.loads(line) for line in f]
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as path:
+            inp, out = os.path.join(path, 'queries.jsonl'), os.path.join(path, 'reports.jsonl.gz')
+            args = [inp, '--out', out, '--backend', 'fake', '--perturbation', 'dummy_token', '--n-perturb', '3',
+                    '--checkpoint-every', '2', '--max-queries', '3']
+            self.write_queries(inp, 5)
+            self.assertEqual(batch.main(args), (5, 0))
+            reports = self.read_reports(out)
+            self.assertEqual(sorted(r['id'] for r in reports), ['q%i'%i for i in range(5)])
+            self.assertEqual(len(reports[0]['perturbed']), 3)
+            self.assertEqual(reports[0]['perturbed'][0][0][-1]['role'], 'user')
+
+            # a crash after the last checkpoint: the partial chunk is cut off, and the unfinished queries run again
+            with open(out, 'ab') as f:
+                f.write(gzip.compress(b'{"id": "q0"')[:20])
+            self.write_queries(inp, 8)
+            self.assertEqual(batch.main(args + ['--resume']), (8, 0))
+            reports = self.read_reports(out)
+            self.assertEqual(sorted(r['id'] for r in reports), sorted('q%i'%i for i in range(8)))
+
+            # a torn checkpoint line is cut off on resume, so the checkpoints written after it are read next time
+            with open(out + '.ckpt', 'a') as f:
+                f.write('{"lines": [[0, ')
+            self.write_queries(inp, 10)
+            self.assertEqual(batch.main(args + ['--resume']), (10, 0))
+            done, offset, _ = batch.read_checkpoint(out + '.ckpt')
+            self.assertEqual((len(done), offset), (10, os.path.getsize(out)))
+            reports = self.read_reports(out)
+            self.assertEqual(sorted(r['id'] for r in reports), sorted('q%i'%i for i in range(10)))
+
+
+    def test_line_ranges(self):
+        done = batch.LineRanges()
+        for start, end in [(5, 6), (0, 2), (3, 4), (2, 3), (8, 10), (4, 5)]:
+            done.add_range(start, end)
+        self.assertEqual(done.ranges(), [[0, 6], [8, 10]])
+        self.assertEqual(len(done), 8)
+        self.assertEqual([i for i in range(12) if i not in done], [6, 7, 10, 11])
+        self.assertEqual(batch.to_ranges([1, 2, 3, 7, 9, 10]), [[1, 4], [7, 8], [9, 11]])
+
+    def test_make_llms(self):
+        args = Namespace(backend='fake', base_url=None, max_retries=0, cache=None, seed=None, max_concurrency=4,
+                         model='gpt-3.5-turbo-0301', paraphrase_model=None)
+        llm, paraphrase_llm = batch.make_llms(args)
+        self.assertIs(paraphrase_llm, llm)
+
+        # another paraphraser shares the bound on the requests in flight, instead of doubling it
+        args.paraphrase_model = 'gpt-4'
+        llm, paraphrase_llm = batch.make_llms(args)
+        self.assertEqual(paraphrase_llm.model, 'gpt-4')
+        self.assertIs(paraphrase_llm.slots, llm.slots)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bertscore import BertScoreEngine
+import numpy as np
+import unittest
+
+
+class TestBertScore(unittest.TestCase):
+
+    def __init__(self, methodName='runTest'):
+        super().__init__(methodName)
+        """
+        the engine must return the same F1 as HF evaluate's bertscore
+        """
+        self.texts = ['', 'Yes it is.', 'It is true.', 'Yes.', 'No, 3 is greater.', 'Well it depends.']
+
+    def test(self):
+        from evaluate import load as hf_load
+        self.engine = BertScoreEngine(lang='en')
+        self.bertscore = hf_load('bertscore')
+        for a in self.texts[1:]:
+            expected = self.bertscore.compute(predictions=self.texts, references=[a] * len(self.texts), lang='en')['f1']
+            self.assertTrue(np.allclose(self.engine.score_batch(a, self.texts), expected, atol=1e-4))
+            self.assertAlmostEqual(self.engine.score(a, self.texts[1]), expected[1], places=4)
+        # the embeddings of each text are cached
+        self.assertEqual(len(self.engine.cache), len(self.texts))
+
+
+if __name__ == '__main__':
+    unittest.main()
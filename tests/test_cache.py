@@ -0,0 +1,53 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cache import ResponseCache, SQLiteResponseCache
+import tempfile
+import time
+import unittest
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def __init__(self, methodName='runTest'):
+        super().__init__(methodName)
+        """
+        the same (model, messages, temperature, seed) returns the cached response,
+        while a different `sample` index is a different request
+        """
+        self.messages = [{'role': 'user', 'content': 'Is 100 greater than 3?'}]
+
+    def check(self, cache):
+        k0 = cache.key('gpt-3.5-turbo-0301', self.messages, 0.7)
+        k1 = cache.key('gpt-3.5-turbo-0301', self.messages, 0.7, sample=1)
+        self.assertNotEqual(k0, k1)
+        self.assertTrue(cache.get(k0) is None)
+        cache.put(k0, 'Yes.')
+        cache.put(k1, 'Yes, it is.')
+        self.assertEqual(cache.get(k0), 'Yes.')
+        self.assertEqual(cache.get(k1), 'Yes, it is.')
+
+        # k1 is the most recently used, so k0 is evicted
+        cache.max_entries = 2
+        cache.put('k2', 'No.')
+        self.assertTrue(cache.get(k0) is None)
+        self.assertEqual(len(cache), 2)
+
+        cache.ttl = 0.01
+        time.sleep(0.02)
+        self.assertTrue(cache.get(k1) is None)
+        print(cache.stats())
+
+    def test_memory(self):
+        self.check(ResponseCache())
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as path:
+            self.check(SQLiteResponseCache(os.path.join(path, 'cache.sqlite')))
+
+            # persisted across instances
+            cache = SQLiteResponseCache(os.path.join(path, 'cache.sqlite'), replay=True)
+            self.assertEqual(cache.get('k2'), 'No.')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from llms import LLM, Backend, FakeBackend, LocalBackend
+from cache import ResponseCache, CacheMiss
+import asyncio
+import json
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _ChatCompletions(BaseHTTPRequestHandler):
+    # a minimal OpenAI-compatible endpoint, keeping the connections alive, and ignoring `n` as llama.cpp does
+    protocol_version = 'HTTP/1.1'
+    n_requests = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        type(self).n_requests += 1
+        body = json.dumps({
+            'id': 'x', 'object': 'chat.completion', 'created': 0, 'model': 'fake',
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': 'Yes.'}}],
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestLLM(unittest.TestCase):
+
+    def __init__(self, methodName='runTest'):
+        super().__init__(methodName)
+        """
+        the fake backend makes these tests run offline and deterministic
+        """
+        self.messages = [{'role': 'user', 'content': 'Is 100 greater than 3?'}]
+        self.other = [{'role': 'user', 'content': 'Is 3 greater than 100?'}]
+
+    def test_generate_many(self):
+        backend = FakeBackend()
+        llm = LLM(backend=backend)
+        perturbed = [(self.messages, 0.7), (self.other, 0.7), (self.messages, 0.7), (self.messages, 0.)]
+        outs = llm.generate_many(perturbed, max_workers=2)
+        print(outs)
+        self.assertEqual(len(outs), len(perturbed))
+        self.assertEqual(backend.n_requests, 3)     # the identical pairs share one n=2 request
+        self.assertEqual(outs[3], llm.generate(self.messages, 0.))
+        self.assertEqual(outs, LLM(backend=FakeBackend()).generate_many(perturbed))
+
+    def test_agenerate(self):
+        llm = LLM(backend=FakeBackend(latency=0.01), max_concurrency=2)
+        perturbed = [(self.messages, 0.7)] * 3 + [(self.other, 0.7)]
+        outs = asyncio.run(llm.agenerate_many(perturbed, max_workers=2))
+        self.assertEqual(outs, LLM(backend=FakeBackend()).generate_many(perturbed))
+
+    def test_slots(self):
+        # the coroutines waiting for a slot do not hold the executor threads that the sync backend runs in
+        class SyncBackend(Backend):
+            def generate(self, model, messages, temperature, n=1, seed=None, json_mode=False):
+                time.sleep(0.01)
+                return ['Yes.'] * n
+
+        llm = LLM(backend=SyncBackend(), max_concurrency=1)
+        prompts = [[{'role': 'user', 'content': 'Is %i greater than 3?'%i}] for i in range(8)]
+
+        async def run():
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(4))
+            outs = await asyncio.wait_for(asyncio.gather(*[llm.agenerate(x, 0.7) for x in prompts]), 5)
+            self.assertEqual(outs, ['Yes.'] * 8)
+
+            # a cancelled waiter gives its slot back, and the threads share the same slots
+            holder = asyncio.ensure_future(llm.agenerate(prompts[1], 0.7))
+            waiter = asyncio.ensure_future(llm.agenerate(prompts[0], 0.7))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await holder
+            self.assertEqual(llm.slots.free, 1)
+            outs = await asyncio.wait_for(asyncio.gather(
+                asyncio.to_thread(llm.generate, prompts[2], 0.7), llm.agenerate(prompts[3], 0.7)), 5)
+            self.assertEqual(outs, ['Yes.'] * 2)
+            self.assertEqual(llm.slots.free, 1)
+
+        asyncio.run(run())
+
+    def test_event_loops(self):
+        # the async client of one event loop is not reused by the next one, whose connections it cannot use
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _ChatCompletions)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            llm = LLM(backend=LocalBackend(base_url='http://127.0.0.1:%i/v1'%server.server_address[1], max_retries=0))
+            for _ in range(2):
+                self.assertEqual(asyncio.run(llm.agenerate(self.messages, 0.7)), 'Yes.')
+
+            # the outputs missing from a single-choice response are generated one by one
+            _ChatCompletions.n_requests = 0
+            self.assertEqual(llm.generate_n(self.messages, 0.7, 3), ['Yes.'] * 3)
+            self.assertEqual(asyncio.run(llm.agenerate_n(self.messages, 0.7, 3)), ['Yes.'] * 3)
+            self.assertEqual(_ChatCompletions.n_requests, 6)
+        finally:
+            server.shutdown()
+
+    def test_cache(self):
+        cache = ResponseCache()
+        llm = LLM(backend=FakeBackend(), cache=cache)
+        outs = llm.generate_many([(self.messages, 0.7)] * 3)
+
+        # replayed from the cache, without calling the backend
+        cache.replay = True
+        backend = FakeBackend()
+        llm = LLM(backend=backend, cache=cache)
+        self.assertEqual(llm.generate_many([(self.messages, 0.7)] * 3), outs)
+        self.assertEqual(backend.n_requests, 0)
+        with self.assertRaises(CacheMiss):
+            llm.generate(self.other, 0.7)
+
+    def test_cache_equal_messages(self):
+        # equal messages in distinct objects are distinct samples, not one cached response
+        cache = ResponseCache()
+        backend = FakeBackend()
+        llm = LLM(backend=backend, cache=cache)
+        copies = [([dict(m) for m in self.messages], 0.7) for _ in range(3)]
+        outs = llm.generate_many(copies)
+        self.assertEqual(backend.n_requests, 3)
+        self.assertEqual(len(cache.entries), 3)
+        self.assertEqual(outs, LLM(backend=FakeBackend()).generate_many([(self.messages, 0.7)] * 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
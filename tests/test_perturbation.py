@@ -1,6 +1,7 @@
 import os, sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from perturbation import TemperaturePerturbation, DummyToken, RandSysMsg, Paraphrasing
+from perturbation import TemperaturePerturbation, DummyToken, RandSysMsg, Paraphrasing, PerturbedMessages
+from llms import LLM, Backend
 import numpy as np
 import unittest
 import pdb
@@ -41,6 +42,12 @@ class TestAggregation(unittest.TestCase):
         print(perturbed)
         self.assertTrue(isinstance(perturbed, list))
         self.assertTrue(len(perturbed) == self.n)
+
+        # with 2 buckets, the n variants share at most 2 distinct temperatures
+        perturbation = TemperaturePerturbation(n=self.n, n_buckets=2)
+        perturbed = perturbation.perturb(self.messages, self.temperature)
+        print(perturbed)
+        self.assertTrue(set(t for _, t in perturbed) <= {0.25, 0.75})
         
 
     def test_prompt_perturbation(self):
@@ -52,5 +59,88 @@ class TestAggregation(unittest.TestCase):
             self.assertTrue(isinstance(perturbed, list))
             self.assertTrue(len(perturbed) == self.n)
 
+
+    def test_paraphrase_retry(self):
+        class ScriptedBackend(Backend):
+            def __init__(self, outputs):
+                self.outputs = outputs
+                self.requests = []
+            def generate(self, model, messages, temperature, n=1, seed=None, json_mode=False):
+                self.requests.append(messages[-1]['content'])
+                return [self.outputs[len(self.requests) - 1]]
+
+        backend = ScriptedBackend([
+            'Sure! {"paraphrased": ["Is 3 less than 100?", "Is 3 less than 100?", ""]} hope it {helps}',
+            '{"paraphrased": ["Does 100 exceed 3?"]}',
+        ])
+        perturbation = Paraphrasing(n=2, llm=LLM(backend=backend))
+        perturbed = perturbation.perturb(self.messages, self.temperature)
+        # the duplicate and empty paraphrases are dropped, the missing one is requested again
+        self.assertEqual([x[-1]['content'] for x, _ in perturbed], ['Is 3 less than 100?', 'Does 100 exceed 3?'])
+        self.assertEqual(len(backend.requests), 2)
+        self.assertTrue('Suggest 1 ways' in backend.requests[1])
+
+        # cached per prompt
+        perturbation.perturb(self.messages, self.temperature)
+        self.assertEqual(len(backend.requests), 2)
+
+        # falls back to the original prompt
+        perturbation = Paraphrasing(n=2, llm=LLM(backend=ScriptedBackend(['no JSON'] * 3)))
+        perturbed = perturbation.perturb(self.messages, self.temperature)
+        self.assertEqual([x[-1]['content'] for x, _ in perturbed], [self.messages[-1]['content']] * 2)
+
+
+    def test_perturbed_messages(self):
+        # the original messages are shared, not copied, and not modified
+        messages = [
+            {'role': 'user', 'content': 'Is 100 greater than 3?'},
+            {'role': 'assistant', 'content': 'Yes.'},
+            {'role': 'user', 'content': 'Are you sure?'},
+        ]
+        x = PerturbedMessages(messages, system='You are a nice assistant.', last_content='Are you sure??')
+        self.assertEqual(len(x), 4)
+        self.assertEqual(x[0], {'role': 'system', 'content': 'You are a nice assistant.'})
+        self.assertTrue(x[1] is messages[0])
+        self.assertEqual(x[-1], {'role': 'user', 'content': 'Are you sure??'})
+        self.assertEqual(x, [x[0]] + messages[:-1] + [x[-1]])
+        self.assertEqual(messages[-1]['content'], 'Are you sure?')
+
+
+    def test_cache_friendly(self):
+        from prompt_cache import prompt_cache_stats
+        messages = [
+            {'role': 'user', 'content': 'Is 100 greater than 3?'},
+            {'role': 'assistant', 'content': 'Yes.'},
+            {'role': 'user', 'content': 'Are you sure?'},
+        ]
+        for _Perturbation in [RandSysMsg, DummyToken]:
+            perturbed = _Perturbation(n=self.n, cache_friendly=True).perturb(messages, self.temperature)
+            for x, _ in perturbed:
+                # only the tail is perturbed, the conversation so far is a shared prefix
+                self.assertEqual(x[:2], messages[:2])
+                self.assertTrue(x[-1]['content'].startswith('Are you sure?'))
+            stats = prompt_cache_stats(messages, perturbed)
+            self.assertEqual(stats['cached'] + stats['uncached'], stats['total'])
+            default = prompt_cache_stats(messages, RandSysMsg(n=self.n).perturb(messages, self.temperature))
+            self.assertTrue(stats['shared_prefix'] > default['shared_prefix'])
+            self.assertTrue(stats['cached'] > default['cached'])
+
+        # the temperature variants are separate requests of the same prompt, all cached but the first
+        perturbed = TemperaturePerturbation(n=5).perturb(messages, self.temperature)
+        stats = prompt_cache_stats(messages, perturbed)
+        single = prompt_cache_stats(messages, perturbed[:1])['total']
+        self.assertEqual(stats['total'], 5 * single)
+        self.assertEqual(stats['cached'], 4 * single)
+        # unless they are in the same temperature bucket, then sent in a single request
+        perturbed = TemperaturePerturbation(n=5, n_buckets=1).perturb(messages, self.temperature)
+        self.assertEqual(prompt_cache_stats(messages, perturbed), {'total': single, 'cached': 0, 'uncached': single,
+                                                                   'shared_prefix': single})
+
+        x = PerturbedMessages(messages, system='You are a nice assistant.', system_tail=True)
+        self.assertEqual(x[2], {'role': 'system', 'content': 'You are a nice assistant.'})
+        self.assertEqual(list(x), messages[:2] + [x[2], messages[2]])
+        self.assertEqual(x, x.materialize())
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,42 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rouge import RougeEngine
+from rouge_score import rouge_scorer
+import numpy as np
+import unittest
+
+
+class TestRouge(unittest.TestCase):
+
+    def __init__(self, methodName='runTest'):
+        super().__init__(methodName)
+        """
+        the engine must return exactly the same scores as rouge_score
+        """
+        self.engine = RougeEngine()
+        self.scorer = rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True)
+        words = ['the', 'a', 'cat', 'cats', 'running', 'runs', 'ran', 'is', 'was', 'It', ',', '...', '?', '100', '3']
+        rng = np.random.RandomState(2024)
+        self.texts = ['', 'this is one sentence.', 'it is a sentence.', 'how are you?'] + [
+            ' '.join(rng.choice(words, rng.randint(1, 60))) for _ in range(30)
+        ]
+
+    def test(self):
+        for method in ['rouge1', 'rouge2', 'rougeL']:
+            for a in self.texts:
+                expected = [self.scorer.score(a, b)[method].fmeasure for b in self.texts]
+                self.assertEqual(list(self.engine.score_batch(a, self.texts, method)), expected)
+                self.assertEqual(self.engine.score(a, self.texts[1], method), expected[1])
+
+
+    def test_bounded(self):
+        # the engine only keeps the tokens of the last `max_size` texts, and still scores exactly
+        engine = RougeEngine(max_size=2)
+        for a in self.texts:
+            expected = [self.scorer.score(a, b)['rougeL'].fmeasure for b in self.texts]
+            self.assertEqual(list(engine.score_batch(a, self.texts, 'rougeL')), expected)
+        self.assertEqual(len(engine.cache), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
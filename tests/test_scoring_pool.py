@@ -0,0 +1,48 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scoring_pool import ScoringPool
+from text_sim import TextSimilarity
+from spuq import SPUQ
+from llms import LLM, FakeBackend
+import numpy as np
+import asyncio
+import unittest
+
+
+class TestScoringPool(unittest.TestCase):
+
+    def test(self):
+        """
+        the pool returns the same scores as scoring in this process
+        """
+        texts = ['Yes it is.', 'It is true.', 'Yes.', 'No, 3 is greater.', 'Well it depends.', '', 'naïve café ☕']
+        local = TextSimilarity()
+        with ScoringPool(max_workers=2, preload=['rougeL']) as pool:
+            for method in ['rouge1', 'rougeL']:
+                self.assertEqual(list(pool.score_batch(texts[0], texts, method)),
+                                 list(local.score_batch(texts[0], texts, method)))
+                self.assertTrue(np.array_equal(pool.similarity_matrix(texts, method), local.similarity_matrix(texts, method)))
+            self.assertEqual(pool.score(texts[0], texts[1], 'rougeL'), local.score(texts[0], texts[1], 'rougeL'))
+
+            async def run():
+                return await asyncio.gather(*[pool.ascore_batch(a, texts, 'rougeL') for a in texts])
+            for a, scores in zip(texts, asyncio.run(run())):
+                self.assertEqual(list(scores), list(local.score_batch(a, texts, 'rougeL')))
+
+            # routed from SPUQ, sync and async
+            messages = [{'role': 'user', 'content': 'Is 100 greater than 3?'}]
+            spuq = SPUQ(llm=LLM(backend=FakeBackend()), perturbation='dummy_token', aggregation='rougeL',
+                        n_perturb=3, text_sim=pool)
+            expected = SPUQ(llm=LLM(backend=FakeBackend()), perturbation='dummy_token', aggregation='rougeL',
+                            n_perturb=3)
+            np.random.seed(0)
+            conf = spuq.run(messages, 0.7)['confidence']
+            np.random.seed(0)
+            self.assertEqual(conf, expected.run(messages, 0.7)['confidence'])
+            spuq.llm = LLM(backend=FakeBackend())     # the same outputs again
+            np.random.seed(0)
+            self.assertEqual(asyncio.run(spuq.arun(messages, 0.7))['confidence'], conf)
+
+
+if __name__ == '__main__':
+    unittest.main()
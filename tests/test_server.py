@@ -0,0 +1,71 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import SPUQService
+from llms import LLM, FakeBackend
+import httpx
+import json
+import asyncio
+import unittest
+
+
+class TestServer(unittest.TestCase):
+
+    def test(self):
+        backend = FakeBackend(latency=0.05)
+        request = {'prompt': 'Is 100 greater than 3?', 'perturbation': 'dummy_token', 'aggregation': 'rougeL',
+                   'n_perturb': 3}
+
+        async def run():
+            service = SPUQService(LLM(backend=backend), max_in_flight=1, max_queued=1)
+            server = await service.start(port=0)
+            port = server.sockets[0].getsockname()[1]
+            async with server, httpx.AsyncClient(base_url='http://127.0.0.1:%i'%port) as client:
+                # the identical requests are coalesced onto one computation
+                responses = await asyncio.gather(*[client.post('/score', json=request) for _ in range(5)])
+                self.assertEqual([r.status_code for r in responses], [200] * 5)
+                self.assertEqual(len(set(r.text for r in responses)), 1)
+                self.assertEqual(backend.n_requests, 3)
+                self.assertTrue(0 <= responses[0].json()['confidence'] <= 1)
+
+                # one running and one queued at most, the others are rejected
+                responses = await asyncio.gather(*[
+                    client.post('/score', json={**request, 'prompt': 'Is %i greater than 3?'%i}) for i in range(4)])
+                self.assertEqual(sorted(r.status_code for r in responses), [200, 200, 503, 503])
+
+                for invalid in [{'aggregation': 'no'}, {'perturbation': 'no'}, {'n_perturb': 0}, {'n_perturb': 21},
+                                {'perturbation': 'system_message', 'n_perturb': 10},
+                                {'perturbation': 'dummy_token', 'n_perturb': 12}]:
+                    response = await client.post('/score', json={'prompt': 'Hi', **invalid})
+                    self.assertEqual(response.status_code, 400, invalid)
+                self.assertEqual((await client.post('/score', content=b'not json')).status_code, 400)
+                self.assertEqual((await client.get('/nothing')).status_code, 404)
+                self.assertEqual((await client.get('/health')).json(), {'status': 'ok', 'in_flight': 0, 'queued': 0})
+                metrics = (await client.get('/metrics')).text
+                self.assertTrue('spuq_server_request_total 15.0' in metrics)
+                self.assertTrue('spuq_server_coalesced_total 4.0' in metrics)
+                self.assertTrue('spuq_server_rejected_total 2.0' in metrics)
+
+        asyncio.run(run())
+
+    def test_errors(self):
+        # a ValueError raised by the computation is a server error, not the client's
+        class FailingBackend(FakeBackend):
+            def _generate(self, messages, temperature, n):
+                raise ValueError('no output')
+
+        service = SPUQService(LLM(backend=FailingBackend()))
+        request = json.dumps({'prompt': 'Hi', 'perturbation': 'dummy_token', 'n_perturb': 2}).encode('utf-8')
+        status, _, body = asyncio.run(service.handle('POST', '/score', request))
+        self.assertEqual(status, 500)
+        self.assertTrue('no output' in body)
+
+    def test_spuqs(self):
+        # the SPUQ instances of the least recently used configurations are dropped
+        service = SPUQService(LLM(backend=FakeBackend()), max_spuqs=2)
+        for n_perturb in [1, 2, 1, 3]:
+            service.spuq('dummy_token', 'rougeL', n_perturb)
+        self.assertEqual(list(service.spuqs), [('dummy_token', 'rougeL', 1), ('dummy_token', 'rougeL', 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
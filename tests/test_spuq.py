@@ -1,7 +1,7 @@
 import os, sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from spuq import SPUQ
-from llms import LLM
+from llms import LLM, FakeBackend
 import unittest
 
 class TestSPUQ(unittest.TestCase):
@@ -36,6 +36,47 @@ class TestSPUQ(unittest.TestCase):
 
         self.assertTrue(confidence_1 <= confidence_2)
 
+    def test_fake(self):
+        """
+        run the whole pipeline offline, against a fake LLM
+        """
+        llm = LLM(backend=FakeBackend())
+        for perturbation in ['system_message', 'dummy_token', 'temperature']:
+            spuq = SPUQ(llm=llm, perturbation=perturbation, aggregation='rougeL', n_perturb=3, max_workers=3)
+            messages = [{'role': 'user', 'content': 'Is 100 greater than 3?'}]
+            ret = spuq.run(messages, temperature=0.7)
+            print(perturbation, ret)
+            self.assertEqual(len(ret['perturbed']), 3)
+            self.assertEqual(len(ret['outputs']), 3)
+            self.assertTrue(0 <= ret['confidence'] <= 1)
+
+            results = dict(spuq.run_many([messages] * 4, temperature=0.7, max_queries=2))
+            self.assertEqual(sorted(results), [0, 1, 2, 3])
+
+    def test_early_exit_consistency(self):
+        # the early exit tracks the mean similarity, it cannot gate on another consistency
+        spuq = SPUQ(llm=LLM(backend=FakeBackend()), perturbation='dummy_token', aggregation='rougeL', n_perturb=3,
+                    pairs='all', consistency='spectral')
+        with self.assertRaises(ValueError):
+            spuq.run([{'role': 'user', 'content': 'Is 100 greater than 3?'}], temperature=0.7, threshold=0.5)
+
+    def test_prompt_stats(self):
+        messages = [{'role': 'user', 'content': 'Is 100 greater than 3?'}]
+        for prompt_stats in [False, True]:
+            spuq = SPUQ(llm=LLM(backend=FakeBackend()), perturbation='dummy_token', aggregation='rougeL', n_perturb=3,
+                        prompt_stats=prompt_stats)
+            for report in [spuq.run(messages, 0.7), spuq.run(messages, 0.7, threshold=0.5)]:
+                self.assertEqual('prompt_tokens' in report, prompt_stats)
+        self.assertTrue(report['prompt_tokens']['total'] > 0)
+
+    def test_temperature_buckets(self):
+        backend = FakeBackend()
+        spuq = SPUQ(llm=LLM(backend=backend), perturbation='temperature', aggregation='rougeL', n_perturb=4,
+                    temperature_buckets=1)
+        ret = spuq.run([{'role': 'user', 'content': 'Is 100 greater than 3?'}], temperature=0.7)
+        self.assertEqual([t for _, t in ret['perturbed']], [0.5] * 4)
+        self.assertEqual(backend.n_requests, 1)     # one n=4 request
+
 
 if __name__ == '__main__':
     unittest.main()
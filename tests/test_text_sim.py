@@ -1,6 +1,8 @@
 import os, sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from text_sim import TextSimilarity
+from text_sim import TextSimilarity, EmbeddingCache, shared_model
+import numpy as np
+import tempfile
 import unittest
 
 class TestTextSimilarity(unittest.TestCase):
@@ -33,6 +35,52 @@ class TestTextSimilarity(unittest.TestCase):
             print('%s: score_ab = %.4f, score_ac = %.4f'%(method, score_ab, score_ac))
             self.assertTrue(score_ab >= score_ac)
 
+    def test_batch(self):
+        texts = [self.a, self.b, self.c]
+        for method in ['rougeL', 'sbert']:
+            batch = self.text_sim.score_batch(self.a, [self.b, self.c], method=method)
+            sim = self.text_sim.similarity_matrix(texts, method=method)
+            for j, t in enumerate(texts[1:]):
+                score = self.text_sim.score(self.a, t, method=method)
+                self.assertAlmostEqual(batch[j], score, places=5)
+                self.assertAlmostEqual(sim[0, j + 1], score, places=5)
+                self.assertAlmostEqual(sim[j + 1, 0], score, places=5)
+
+    def test_shared(self):
+        # models are loaded on first use, and then shared by all instances
+        self.assertTrue(TextSimilarity().rouge is self.text_sim.rouge)
+        # the embeddings of another sbert model or backend are cached apart
+        self.assertTrue(TextSimilarity(sbert_backend='int8').cache is not TextSimilarity().cache)
+        self.assertTrue(TextSimilarity(sbert_model='all-MiniLM-L6-v2').cache is not TextSimilarity().cache)
+        # the BERTScore engine is registered per model and number of threads
+        engine = shared_model(('bertscore', 'roberta-large', 4), object)
+        self.assertTrue(TextSimilarity(bertscore_model='roberta-large', bertscore_threads=4).bertscore is engine)
+
+    def test_cache(self):
+        cache = EmbeddingCache(max_size=2)
+        for i in range(3):
+            cache.put(str(i), np.ones(4) * i)
+        self.assertTrue(cache.get('0') is None)     # evicted, least recently used
+        self.assertEqual(cache.get('2')[0], 2)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'evictions': 1, 'size': 2, 'disk_size': 0})
+
+        with tempfile.TemporaryDirectory() as path:
+            cache = EmbeddingCache(max_size=2, path=path)
+            for i in range(3):
+                cache.put(str(i), np.ones(4) * i)
+            cache.flush()
+            cache = EmbeddingCache(max_size=2, path=path)   # warm restart
+            self.assertEqual(cache.get('0')[0], 0)
+            self.assertEqual(cache.stats()['disk_size'], 3)
+
+            # another model, with another embedding dimension, shares the directory
+            cache.put('wide', np.ones(8))
+            cache.flush()
+            cache = EmbeddingCache(max_size=2, path=path)
+            self.assertEqual(cache.get('wide').shape, (8,))
+            self.assertEqual(cache.get('2').shape, (4,))
+            self.assertEqual(cache.stats()['disk_size'], 4)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
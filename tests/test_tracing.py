@@ -0,0 +1,47 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tracing import CallbackSink, CounterRegistry, JsonLinesSink, TimingCollector
+from concurrent.futures import ThreadPoolExecutor
+import tracing
+import io
+import json
+import unittest
+
+
+class TestTracing(unittest.TestCase):
+
+    def test_sinks(self):
+        registry = CounterRegistry()
+        f = io.StringIO()
+        spans = []
+        sinks = [registry, JsonLinesSink(f), CallbackSink(on_span=lambda name, seconds, attrs: spans.append(name))]
+        for sink in sinks:
+            tracing.add_sink(sink)
+        try:
+            with tracing.span('llm.generate', model='gpt-3.5-turbo-0301'):
+                tracing.count('llm.prompt_tokens', 12, model='gpt-3.5-turbo-0301')
+        finally:
+            for sink in sinks:
+                tracing.remove_sink(sink)
+        tracing.count('llm.prompt_tokens', 100)   # no sink anymore
+
+        print(registry.render())
+        self.assertTrue('spuq_span_seconds_count{name="llm.generate"} 1.0' in registry.render())
+        self.assertTrue('spuq_llm_prompt_tokens_total{model="gpt-3.5-turbo-0301"} 12.0' in registry.render())
+        events = [json.loads(line) for line in f.getvalue().splitlines()]
+        self.assertEqual([e['type'] for e in events], ['count', 'span'])
+        self.assertEqual(spans, ['llm.generate'])
+
+    def test_collect(self):
+        # the events emitted from the worker threads reach the collector of the caller's context
+        with tracing.collect(TimingCollector()) as collector:
+            with ThreadPoolExecutor(2) as pool:
+                for _ in range(3):
+                    pool.submit(tracing.bind(tracing.count), 'llm.cache_hit')
+        with ThreadPoolExecutor(2) as pool:
+            pool.submit(tracing.bind(tracing.count), 'llm.cache_hit')
+        self.assertEqual(collector.summary()['counters'], {'llm.cache_hit': 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
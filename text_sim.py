@@ -1,41 +1,333 @@
-from sentence_transformers import SentenceTransformer
-from rouge_score import rouge_scorer
-from evaluate import load as hf_load
 import numpy as np
+import threading
+import hashlib
+import os
+from collections import OrderedDict
+import tracing
 import pdb
 
+
+SBERT_MODEL = 'paraphrase-multilingual-mpnet-base-v2'
+
+# the models are loaded on first use, and shared by all the TextSimilarity instances in the process
+_models = {}
+_models_lock = threading.Lock()
+
+
+def shared_model(key, loader):
+    """
+    return the model registered under `key`, calling `loader()` to load it on first use
+    """
+    with _models_lock:
+        if key not in _models:
+            _models[key] = loader()
+        return _models[key]
+
+
+SBERT_BACKENDS = ['torch', 'int8', 'onnx']
+
+
+class _OnnxEmbedder:
+    """
+    a sentence-transformers model exported to ONNX Runtime (via optimum), with the mean pooling
+    of the paraphrase / MiniLM sentence-transformers models
+    """
+
+    def __init__(self, name) -> None:
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        name = name if '/' in name else 'sentence-transformers/' + name
+        self.tokenizer = AutoTokenizer.from_pretrained(name)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(name, export=True)
+
+    def encode(self, texts, batch_size=32) -> np.ndarray:
+        embs = []
+        for start in range(0, len(texts), batch_size):
+            x = self.tokenizer(texts[start: start + batch_size], padding=True, truncation=True, return_tensors='np')
+            tokens = self.model(**x).last_hidden_state
+            mask = x['attention_mask'][..., None].astype(np.float32)
+            embs.append((tokens * mask).sum(1) / np.maximum(mask.sum(1), 1e-9))
+        return np.concatenate(embs)
+
+
+def _load_sbert(name, backend='torch'):
+    """
+    `backend` is one of:
+    * `torch`: the fp32 PyTorch model
+    * `int8`: the PyTorch model with its linear layers dynamically quantized to int8, for CPU
+    * `onnx`: the model exported to ONNX Runtime, needs `optimum[onnxruntime]`
+    """
+    if backend == 'onnx':
+        return _OnnxEmbedder(name)
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(name, device='cpu' if backend == 'int8' else None)
+    if backend == 'int8':
+        import torch
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def _load_rouge():
+    from rouge import RougeEngine
+    return RougeEngine()
+
+
+def _load_bertscore(model_type=None, num_threads=None):
+    from bertscore import BertScoreEngine
+    return BertScoreEngine(lang='en', model_type=model_type, num_threads=num_threads)
+
+
+class EmbeddingCache:
+    """
+    content-hash keyed cache of embeddings (one vector per text)
+    * an in-memory LRU tier, bounded to `max_size` entries
+    * an optional on-disk tier under directory `path`, a memory-mapped numpy array plus a key index per embedding
+    dimension (so several models can share `path`), so a warm restart does not need to re-encode the texts seen before
+    """
+
+    def __init__(self, max_size=10000, path=None) -> None:
+        assert(max_size > 0)
+        self.max_size = max_size
+        self.mem = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.path = path
+        self.rows = {}          # key -> (dimension, row index in the on-disk array of that dimension)
+        self.disks = {}         # dimension -> memory-mapped array
+        self.sizes = {}         # dimension -> number of rows in use
+        self.keys_files = {}    # dimension -> key index, opened on the first append
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            for name in os.listdir(path):
+                if not (name.startswith('embeddings_') and name.endswith('.npy')):
+                    continue
+                dim = int(name[len('embeddings_'): -len('.npy')])
+                self.disks[dim] = np.load(self._disk_path(dim), mmap_mode='r+')
+                self.sizes[dim] = 0
+                if os.path.exists(self._keys_path(dim)):
+                    # a key is only written after its row, so every key listed here has its embedding
+                    with open(self._keys_path(dim)) as f:
+                        for line in f:
+                            self.rows[line.strip()] = (dim, self.sizes[dim])
+                            self.sizes[dim] += 1
+
+
+    @staticmethod
+    def key(namespace: str, text: str) -> str:
+        return hashlib.sha1((namespace + '\0' + text).encode('utf-8')).hexdigest()
+
+
+    def _disk_path(self, dim):
+        return os.path.join(self.path, 'embeddings_%i.npy'%dim)
+
+
+    def _keys_path(self, dim):
+        return os.path.join(self.path, 'keys_%i.txt'%dim)
+
+
+    def _disk_append(self, key, emb):
+        dim = emb.shape[-1]
+        n = self.sizes.get(dim, 0)
+        if dim not in self.disks or n == self.disks[dim].shape[0]:
+            # (re)allocate the memory-mapped array with double the capacity
+            capacity = max(1024, 2 * n)
+            tmp_path = self._disk_path(dim) + '.tmp'
+            disk = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(capacity, dim))
+            if n:
+                disk[:n] = self.disks[dim][:n]
+            disk.flush()
+            del disk
+            os.replace(tmp_path, self._disk_path(dim))
+            self.disks[dim] = np.load(self._disk_path(dim), mmap_mode='r+')
+        if dim not in self.keys_files:
+            self.keys_files[dim] = open(self._keys_path(dim), 'a' if n else 'w')
+        self.disks[dim][n] = emb
+        self.rows[key] = (dim, n)
+        self.sizes[dim] = n + 1
+        self.keys_files[dim].write(key + '\n')
+        self.keys_files[dim].flush()
+
+
+    def get(self, key: str):
+        """
+        return the cached embedding, or None if it is not in the cache
+        """
+        with self.lock:
+            if key in self.mem:
+                self.mem.move_to_end(key)
+                self.hits += 1
+                return self.mem[key]
+            if key in self.rows:
+                dim, row = self.rows[key]
+                emb = np.array(self.disks[dim][row])
+                self._put_mem(key, emb)
+                self.hits += 1
+                return emb
+            self.misses += 1
+            return None
+
+
+    def _put_mem(self, key, emb):
+        self.mem[key] = emb
+        self.mem.move_to_end(key)
+        while len(self.mem) > self.max_size:
+            self.mem.popitem(last=False)
+            self.evictions += 1
+
+
+    def put(self, key: str, emb: np.ndarray):
+        with self.lock:
+            self._put_mem(key, emb)
+            if self.path is not None and key not in self.rows:
+                self._disk_append(key, emb)
+
+
+    def flush(self):
+        with self.lock:
+            for disk in self.disks.values():
+                disk.flush()
+
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.mem),
+            'disk_size': len(self.rows),
+        }
+
+
 class TextSimilarity:
+    """
+    `sbert_model` and `sbert_backend` (see `_load_sbert`) select the sentence-bert embedder,
+    e.g. a smaller model (all-MiniLM-L6-v2) or int8 / ONNX inference, to trade some accuracy for CPU throughput.
+    `bertscore_model` (by default, the one of bert_score for English) and `bertscore_threads` (the number of torch
+    CPU threads, process-wide) configure the BERTScore engine, see bertscore.py
+    """
+
+    def __init__(self, cache: EmbeddingCache = None, sbert_model=SBERT_MODEL, sbert_backend='torch',
+                 bertscore_model=None, bertscore_threads=None) -> None:
+        assert(sbert_backend in SBERT_BACKENDS)
+        self.sbert_model = sbert_model
+        self.sbert_backend = sbert_backend
+        self.bertscore_model = bertscore_model
+        self.bertscore_threads = bertscore_threads
+        # the embeddings of each (model, backend) are cached apart
+        self.namespace = sbert_model if sbert_backend == 'torch' else '%s/%s'%(sbert_model, sbert_backend)
+        # by default, the sbert embeddings are cached in memory, shared by the whole process
+        self.cache = cache if cache is not None else shared_model(('sbert_cache', self.namespace), EmbeddingCache)
+
+
+    @property
+    def embedder(self):
+        return shared_model(('sbert', self.sbert_model, self.sbert_backend),
+                            lambda: _load_sbert(self.sbert_model, self.sbert_backend))
 
-    def __init__(self) -> None:
-        self.embedder = SentenceTransformer( 'paraphrase-multilingual-mpnet-base-v2')
-        self.rouge_scorer = rouge_scorer.RougeScorer(['rouge1', 'rouge2', 'rougeL'], use_stemmer=True)
-        self.bertscore = hf_load("bertscore")
+    @property
+    def rouge(self):
+        # same scores as rouge_score's RougeScorer (with stemming), see rouge.py
+        return shared_model(('rouge',), _load_rouge)
+
+    @property
+    def bertscore(self):
+        # same F1 as HF evaluate's bertscore (lang='en'), with the model resident, see bertscore.py
+        return shared_model(('bertscore', self.bertscore_model, self.bertscore_threads),
+                            lambda: _load_bertscore(self.bertscore_model, self.bertscore_threads))
+
+
+    def embed(self, texts: list) -> np.ndarray:
+        """
+        the L2-normalized sentence-bert embeddings of `texts`,
+        each unique text is encoded only once, and only if it is not cached yet
+        """
+        keys = {t: self.cache.key(self.namespace, t) for t in texts}
+        cached = {t: self.cache.get(k) for t, k in keys.items()}
+        missing = [t for t, emb in cached.items() if emb is None]
+        if missing:
+            embs = self.embedder.encode(missing)
+            embs = embs / np.sqrt((embs * embs).sum(-1)).reshape(-1, 1)
+            for t, emb in zip(missing, embs):
+                emb = np.array(emb, dtype=np.float32)
+                self.cache.put(keys[t], emb)
+                cached[t] = emb
+        if not texts:
+            return np.zeros((0, 1))
+        return np.stack([cached[t] for t in texts])
 
 
     def score(self, a: str, b: str, method: str) -> float:
-        
+        with tracing.span('text_sim.score', method=method):
+            return self._score(a, b, method)
+
+
+    def _score(self, a: str, b: str, method: str) -> float:
+
         if method == 'sbert':
             # the cosine similarity of the sentence-bert embedding
             # see https://arxiv.org/abs/1908.10084
 
-            embs = self.embedder.encode([a, b])
-            norm = np.sqrt((embs * embs).sum(-1))
-            norm_embs = embs / norm.reshape(-1, 1)
-            cos_sim = (norm_embs[0] * norm_embs[1]).sum(-1)
-            return cos_sim
-        
+            return self._score_batch(a, [b], method)[0]
+
         elif method in ['rouge1', 'rouge2', 'rougeL']:
             # ROUGE score: https://en.wikipedia.org/wiki/ROUGE_(metric)
 
-            return self.rouge_scorer.score(a, b)[method].fmeasure
+            return self.rouge.score(a, b, method)
 
         elif method == 'bertscore':
             # BERTScore: https://arxiv.org/abs/1904.09675
             # which cross check the contextualized word embedding between two sentence
 
-            results = self.bertscore.compute(predictions=[b], references=[a], lang="en")
-            return results['f1'][0]
-        
+            return self.bertscore.score(a, b)
+
         else:
             raise ValueError('text_similarity method not supported: %s'%method)
-        
\ No newline at end of file
+
+
+    def score_batch(self, a: str, bb: list, method: str) -> np.ndarray:
+        """
+        score the reference `a` against each of the candidates in `bb`,
+        same as [self.score(a, b, method) for b in bb], but batched
+        """
+        with tracing.span('text_sim.score_batch', method=method, n=len(bb)):
+            return self._score_batch(a, bb, method)
+
+
+    def _score_batch(self, a: str, bb: list, method: str) -> np.ndarray:
+        if not bb:
+            return np.zeros(0)
+
+        if method == 'sbert':
+            embs = self.embed([a] + list(bb))
+            return embs[1:] @ embs[0]
+
+        elif method in ['rouge1', 'rouge2', 'rougeL']:
+            return self.rouge.score_batch(a, bb, method)
+
+        elif method == 'bertscore':
+            return self.bertscore.score_batch(a, bb)
+
+        else:
+            raise ValueError('text_similarity method not supported: %s'%method)
+
+
+    def similarity_matrix(self, texts: list, method: str) -> np.ndarray:
+        """
+        the N x N matrix of the pairwise similarity between `texts`.
+        all the supported methods are symmetric, so only the upper triangle is scored,
+        and the diagonal is set to 1.
+        """
+        n = len(texts)
+        if method == 'sbert':
+            embs = self.embed(texts)
+            sim = embs @ embs.T
+        else:
+            sim = np.zeros((n, n))
+            for i in range(n - 1):
+                sim[i, i + 1:] = self.score_batch(texts[i], texts[i + 1:], method)
+            sim = sim + sim.T
+        np.fill_diagonal(sim, 1.)
+        return sim
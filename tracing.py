@@ -0,0 +1,186 @@
+"""
+instrumentation of the SPUQ pipeline: timing spans and counters, emitted to pluggable sinks.
+
+the sinks added by `add_sink` receive the events of the whole process,
+while `collect(sink)` only receives the events of the current context (e.g. one SPUQ.run).
+without any sink, `span` and `count` do (almost) nothing.
+"""
+
+import contextvars
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Sink:
+    """
+    the interface of a sink, override `span` and/or `count`
+    """
+
+    def span(self, name: str, seconds: float, attrs: dict):
+        pass
+
+    def count(self, name: str, value: float, attrs: dict):
+        pass
+
+
+class CallbackSink(Sink):
+    """
+    forward the events to callbacks, `on_span(name, seconds, attrs)` and `on_count(name, value, attrs)`
+    """
+
+    def __init__(self, on_span=None, on_count=None) -> None:
+        self.on_span = on_span
+        self.on_count = on_count
+
+    def span(self, name, seconds, attrs):
+        if self.on_span is not None:
+            self.on_span(name, seconds, attrs)
+
+    def count(self, name, value, attrs):
+        if self.on_count is not None:
+            self.on_count(name, value, attrs)
+
+
+class CounterRegistry(Sink):
+    """
+    Prometheus-style registry: the counters are summed by (name, attrs),
+    and the spans are summarized by their total seconds and count.
+    `render` returns the Prometheus text exposition format
+    """
+
+    def __init__(self, prefix='spuq') -> None:
+        self.prefix = prefix
+        self.counters = defaultdict(float)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _labels(attrs):
+        return tuple(sorted((k, str(v)) for k, v in attrs.items()))
+
+    def span(self, name, seconds, attrs):
+        with self.lock:
+            self.counters[('span_seconds_sum', (('name', name),))] += seconds
+            self.counters[('span_seconds_count', (('name', name),))] += 1
+
+    def count(self, name, value, attrs):
+        with self.lock:
+            self.counters[(name.replace('.', '_') + '_total', self._labels(attrs))] += value
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                labels = ','.join('%s="%s"'%(k, v.replace('"', '\\"')) for k, v in labels)
+                lines.append('%s_%s%s %s'%(self.prefix, name, '{%s}'%labels if labels else '', repr(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class JsonLinesSink(Sink):
+    """
+    write each event as one JSON line to `f`, a path or a file object
+    """
+
+    def __init__(self, f) -> None:
+        self.f = open(f, 'a') if isinstance(f, str) else f
+        self.lock = threading.Lock()
+
+    def _write(self, event):
+        line = json.dumps(event, default=str)
+        with self.lock:
+            self.f.write(line + '\n')
+            self.f.flush()
+
+    def span(self, name, seconds, attrs):
+        self._write({'type': 'span', 'name': name, 'seconds': seconds, 'time': time.time(), **attrs})
+
+    def count(self, name, value, attrs):
+        self._write({'type': 'count', 'name': name, 'value': value, 'time': time.time(), **attrs})
+
+
+class TimingCollector(Sink):
+    """
+    the timing breakdown of one run: the total seconds and count per span name, and the summed counters
+    """
+
+    def __init__(self) -> None:
+        self.spans = defaultdict(lambda: {'count': 0, 'seconds': 0.})
+        self.counters = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def span(self, name, seconds, attrs):
+        with self.lock:
+            self.spans[name]['count'] += 1
+            self.spans[name]['seconds'] += seconds
+
+    def count(self, name, value, attrs):
+        with self.lock:
+            self.counters[name] += value
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                'spans': {name: dict(span) for name, span in self.spans.items()},
+                'counters': dict(self.counters),
+            }
+
+
+_sinks = []
+_context_sinks = contextvars.ContextVar('spuq_tracing_sinks', default=())
+
+
+def add_sink(sink: Sink):
+    _sinks.append(sink)
+
+
+def remove_sink(sink: Sink):
+    _sinks.remove(sink)
+
+
+def _active():
+    return tuple(_sinks) + _context_sinks.get()
+
+
+@contextmanager
+def collect(sink: Sink):
+    """
+    send the events emitted within this context (including the threads started with `bind`) to `sink`
+    """
+    token = _context_sinks.set(_context_sinks.get() + (sink,))
+    try:
+        yield sink
+    finally:
+        _context_sinks.reset(token)
+
+
+def bind(fn):
+    """
+    bind `fn` to a copy of the current context, so the events it emits from another thread still reach `collect`
+    """
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    time the code within this context. it yields `attrs`, which can still be updated before the span ends
+    """
+    sinks = _active()
+    if not sinks:
+        yield attrs
+        return
+    t0 = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        seconds = time.perf_counter() - t0
+        for sink in sinks:
+            sink.span(name, seconds, attrs)
+
+
+def count(name: str, value=1, **attrs):
+    for sink in _active():
+        sink.count(name, value, attrs)